@@ -0,0 +1,527 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  panel_gen's asyncio engine.                                        #
+#                                                                     #
+#  Optional. Pick it with "scheduler = asyncio" under [engine] in     #
+#  panel_gen.conf. Instead of work_thread, timer_thread, the I/O pool #
+#  and python-ami's listener threads all poking at lines, everything  #
+#  runs as callbacks on one asyncio loop: line timers are             #
+#  loop.call_at(), AMI is a plain asyncio protocol, and AMI actions   #
+#  are written straight to the socket. Only .call file writes leave   #
+#  the loop, on the default executor, because there's no such thing   #
+#  as non-blocking disk I/O.                                          #
+#                                                                     #
+#  The pieces below stand in for the threaded ones with the same      #
+#  methods, so the rest of panel_gen doesn't care which engine it's   #
+#  on. panel_gen imports this when it's asked for.                    #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+from time import sleep
+from functools import partial
+import itertools
+import threading
+import asyncio
+import logging
+from asterisk.ami import Action, Event, Response
+
+from engine import Timer, Pool, TimerHandle
+import panel_gen as app
+
+
+class LoopScheduler(app.Scheduler):
+    """
+    Scheduler for the asyncio engine. Every line with something coming
+    up has a loop.call_at() waiting for its next deadline, and the loop
+    ticks it directly. Nobody polls.
+
+    Everything in here runs on the loop thread. Calls from any other
+    thread get handed over with call_soon_threadsafe.
+
+    loop:       The asyncio event loop. aio_thread runs it.
+    handles:    Dict of line -> asyncio TimerHandle for its next tick.
+    held:       Lines that came due while paused.
+    paused_at:  Loop time we paused at, or None.
+    """
+
+    name = 'asyncio'
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        super().__init__(clock=self.loop.time)
+        self.handles = {}
+        self.held = set()
+        self.paused_at = None
+        self.checking = False
+        self.thread_id = None
+
+    def on_loop(self):
+        return threading.get_ident() == self.thread_id
+
+    def wake(self):
+        # AMI events are waiting. On the loop, that just means one more
+        # callback, after whatever else is ready right now.
+        self.loop.call_soon_threadsafe(app.inbox.drain)
+
+    def reschedule(self, line, not_before=None):
+        if not self.on_loop():
+            self.loop.call_soon_threadsafe(self.reschedule, line, not_before)
+            return
+        if line.scheduled == False:
+            return
+        deadline = line.next_deadline()
+        if not_before is not None and deadline < not_before:
+            deadline = not_before
+        old = self.handles.pop(line, None)
+        if old is not None:
+            old.cancel()
+        # Parked lines have no deadline. admit() will bring them back.
+        if deadline != float('inf'):
+            self.handles[line] = self.loop.call_at(deadline, self.fire, line)
+
+    def cancel(self, line):
+        line.scheduled = False
+        if not self.on_loop():
+            self.loop.call_soon_threadsafe(self.cancel, line)
+            return
+        handle = self.handles.pop(line, None)
+        if handle is not None:
+            handle.cancel()
+        self.held.discard(line)
+
+    def fire(self, line):
+        self.handles.pop(line, None)
+        if self.paused_at is not None:
+            self.held.add(line)
+            return
+        try:
+            with app.state_lock:
+                line.tick()
+        except Exception as e:
+            logging.exception(e)
+
+        # One sanity check per trip around the loop, not one per line.
+        if not self.checking:
+            self.checking = True
+            self.loop.call_soon(self.check)
+
+        # Never come back for the same line sooner than one tick,
+        # in case it had nothing to do.
+        self.reschedule(line, self.now() + 0.1)
+
+    def check(self):
+        self.checking = False
+        with app.state_lock:
+            app.safetynet()
+
+    def pause(self):
+        self.paused_at = self.now()
+
+    def resume(self):
+        if self.paused_at is None:
+            return
+        self.shift(self.now() - self.paused_at)
+        self.paused_at = None
+        held, self.held = self.held, set()
+        for line in held:
+            self.reschedule(line)
+
+    def shift(self, seconds):
+        for line in list(self.handles) + list(self.held):
+            line.deadline += seconds
+            line.ami_deadline += seconds
+            if line in self.handles:
+                self.reschedule(line)
+
+    def pop_due(self):
+        return []
+
+    def wait(self, timeout):
+        sleep(timeout)
+
+
+class aio_thread(threading.Thread):
+    # Runs the asyncio engine's loop. Takes the place of work_thread,
+    # so it pauses and resumes the same way.
+
+    def __init__(self, scheduler):
+
+        threading.Thread.__init__(self, name='aio_thread')
+        self.scheduler = scheduler
+        self.loop = scheduler.loop
+        self.shutdown_flag = threading.Event()
+        self.paused = False
+
+        logging.info('--- Started panel_gen (asyncio) ---')
+
+    def run(self):
+        self.is_alive = True
+        self.scheduler.thread_id = threading.get_ident()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.watch)
+        try:
+            self.loop.run_forever()
+        except Exception as e:
+            logging.exception(e)
+
+    def watch(self):
+        # Nobody can interrupt run_forever() from outside, so look for
+        # the shutdown flag once a second.
+        if self.shutdown_flag.is_set():
+            self.loop.stop()
+            return
+        self.loop.call_later(1, self.watch)
+
+    def pause(self):
+        self.paused = True
+        self.loop.call_soon_threadsafe(self.scheduler.pause)
+
+    def resume(self):
+        self.paused = False
+        self.loop.call_soon_threadsafe(self.scheduler.resume)
+
+
+class aio_timer(Timer):
+    # Stands in for timer_thread. Callbacks are loop.call_at() handles.
+
+    def __init__(self, loop, lock):
+
+        Timer.__init__(self, loop.time, lock)
+        self.loop = loop
+        self.waiting = 0
+
+    def call_later(self, delay, callback, owner=None):
+        handle = TimerHandle(self.clock() + delay, callback, owner)
+        self.loop.call_soon_threadsafe(self.add, handle)
+        return handle
+
+    def add(self, handle):
+        if handle.cancelled:
+            return
+        with self.cond:
+            self.own(handle)
+        self.waiting += 1
+        self.loop.call_at(handle.due, self.fire, handle)
+
+    def fire(self, handle):
+        self.waiting -= 1
+        Timer.fire(self, handle)
+
+    def pending(self):
+        return self.waiting
+
+
+class aio_pool(Pool):
+    # Stands in for io_pool. AMI actions don't block on this engine, so
+    # they just run on the loop. Blocking jobs (writing .call files) go
+    # to the loop's default executor. Still bounded: past size jobs in
+    # flight, submit() says no.
+
+    def __init__(self, loop, timer, size=64):
+
+        Pool.__init__(self, loop.time, timer)
+        self.loop = loop
+        self.size = size
+        self.in_flight = 0
+
+    def submit(self, job, owner=None, failed=None, blocking=False):
+        with self.lock:
+            if self.in_flight >= self.size:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+        self.loop.call_soon_threadsafe(self.begin, self.clock(), job, owner,
+                                       failed, blocking)
+        return True
+
+    def begin(self, queued_at, job, owner, failed, blocking):
+        if blocking:
+            started = self.clock()
+            future = self.loop.run_in_executor(None, job)
+            future.add_done_callback(
+                lambda f: self.finish(queued_at, started, f.exception(), owner, failed))
+            return
+        self.run_job(queued_at, job, owner, failed)
+
+    def finish(self, queued_at, started, error, owner, failed):
+        with self.lock:
+            self.in_flight -= 1
+        Pool.finish(self, queued_at, started, error, owner, failed)
+
+    def queued(self):
+        return self.in_flight
+
+
+class LoopFuture():
+    """
+    Stands in for python-ami's FutureResponse on the asyncio engine.
+    Reading .response from another thread waits up to timeout seconds
+    for it. On the loop thread it never waits, since that would stop
+    the very loop that's supposed to deliver it.
+    """
+
+    def __init__(self, callback=None, timeout=3):
+        self.callback = callback
+        self.timeout = timeout
+        self.done = threading.Event()
+        self._response = None
+
+    def set(self, response):
+        try:
+            if self.callback is not None:
+                self.callback(response)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self._response = response
+            self.done.set()
+
+    def abandon(self):
+        # No response is coming. Let anyone waiting go, but don't
+        # call the callback, it's expecting a Response.
+        self.done.set()
+
+    @property
+    def response(self):
+        if not self.done.is_set() and not app.scheduler.on_loop():
+            self.done.wait(self.timeout)
+        return self._response
+
+
+class AMIProtocol(asyncio.Protocol):
+    """
+    Bare bones asyncio AMI client. Splits what comes in on the socket
+    into packets, and hands Responses and Events to the aio_ami that
+    owns it. Uses python-ami's Action, Response and Event classes, so
+    everything downstream sees the same objects as on the threaded engine.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.transport = None
+        self.buffer = b''
+        self.greeted = asyncio.get_running_loop().create_future()
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def data_received(self, data):
+        self.buffer += data
+        if not self.greeted.done():
+            # Asterisk says hello with one line, not a whole packet.
+            if b'\r\n' not in self.buffer:
+                return
+            banner, self.buffer = self.buffer.split(b'\r\n', 1)
+            self.greeted.set_result(banner.decode('utf-8', errors='replace'))
+        while b'\r\n\r\n' in self.buffer:
+            pack, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+            pack = pack.decode('utf-8', errors='replace')
+            try:
+                if Response.match(pack):
+                    self.owner.got_response(Response.read(pack))
+                elif Event.match(pack):
+                    self.owner.got_event(Event.read(pack))
+            except Exception as e:
+                logging.exception(e)
+
+    def send(self, action):
+        self.transport.write(bytearray(str(action) + '\r\n', 'utf-8'))
+
+
+class LoopAMIAdapter():
+    """ Same idea as python-ami's AMIClientAdapter, for aio_ami. """
+
+    def __init__(self, ami):
+        self._ami = ami
+
+    def __getattr__(self, item):
+        return partial(self._ami.send, item)
+
+
+class aio_ami():
+    # Our AMI connection on the asyncio engine. Does the same jobs as
+    # ami_manager: log in, set up filtering, ping, reconnect with
+    # backoff, and resync lines after a reconnect. Only one socket here,
+    # because writing an action never has to wait behind reading events.
+
+    def __init__(self, address, port, user, secret, interval=1, backoff_max=30):
+
+        self.address = address
+        self.port = int(port)
+        self.user = user
+        self.secret = secret
+        self.interval = interval
+        self.backoff_max = backoff_max
+        self.loop = None
+        self.protocol = None
+        self.futures = {}
+        self.lists = {}
+        self.counter = itertools.count()
+        self.closing = False
+        self.connected = False
+        self.reconnects = 0
+        self.resyncs = 0
+        self.last_error = ''
+
+    def send(self, name, _callback=None, variables={}, **keys):
+        """
+        Sends an action. Safe from any thread. Returns a LoopFuture.
+        """
+        action = Action(name, keys, variables)
+        if 'ActionID' not in action.keys:
+            action.keys['ActionID'] = str(next(self.counter))
+        future = LoopFuture(_callback)
+        protocol = self.protocol
+        if protocol is None or not self.connected and name != 'Login':
+            future.abandon()
+            return future
+        self.futures[action.keys['ActionID']] = future
+        if app.scheduler.on_loop():
+            protocol.send(action)
+        else:
+            self.loop.call_soon_threadsafe(protocol.send, action)
+        return future
+
+    async def request(self, name, timeout=3, **keys):
+        """ Sends an action from the loop and waits for the Response. """
+        waiter = self.loop.create_future()
+        def answered(response):
+            if not waiter.done():
+                waiter.set_result(response)
+        self.send(name, _callback=answered, **keys)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def got_response(self, response):
+        future = self.futures.pop(response.keys.get('ActionID'), None)
+        if future is not None:
+            future.set(response)
+
+    def got_event(self, event):
+        listing = self.lists.get(event.keys.get('ActionID'))
+        if listing is not None:
+            listing[0].append(event)
+            if event.name.endswith('Complete') and not listing[1].done():
+                listing[1].set_result(listing[0])
+            return
+        if event.name in app.ami_dispatch:
+            app.on_ami_event(event)
+
+    async def connect(self):
+        transport, protocol = await self.loop.create_connection(
+                lambda: AMIProtocol(self), self.address, self.port)
+        self.protocol = protocol
+        await asyncio.wait_for(protocol.greeted, 3)
+
+        response = await self.request('Login', Username=self.user, Secret=self.secret)
+        if response is None or response.is_error():
+            transport.close()
+            raise Exception('AMI login failed: {}'.format(response))
+        self.connected = True
+
+        filtered = True
+        for name, keys in app.ami_filter_steps():
+            response = await self.request(name, **keys)
+            if response is None or response.is_error():
+                logging.warning('AMI %s not accepted: %s', name, response)
+                filtered = False
+                break
+        if not filtered:
+            logging.warning('Filtering AMI events on our end instead.')
+        logging.info('Connected to Asterisk AMI')
+
+    async def resync(self):
+        self.resyncs += 1
+        action_id = 'resync-{}'.format(self.resyncs)
+        listing = ([], self.loop.create_future())
+        self.lists[action_id] = listing
+        try:
+            response = await self.request('CoreShowChannels', ActionID=action_id)
+            if response is None or response.is_error():
+                logging.warning('CoreShowChannels failed: %s', response)
+                return
+            listed = await asyncio.wait_for(listing[1], 5)
+        except asyncio.TimeoutError:
+            logging.warning('CoreShowChannels never finished. Skipping resync.')
+            return
+        finally:
+            del self.lists[action_id]
+
+        live = {}
+        for event in listed:
+            e = app.decode_event(event)
+            if e.token != '':
+                live[e.token] = e.chan
+        with app.state_lock:
+            orphans = app.reconcile_lines(live)
+        # Don't wait around for these, we're on the loop.
+        for chan in orphans:
+            self.send('Hangup', Channel='DAHDI/{}-1'.format(chan))
+
+    def start(self):
+        """ Gets run() going on the scheduler's loop. Safe from any thread. """
+        asyncio.run_coroutine_threadsafe(self.run(), app.scheduler.loop)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        delay = 1
+        first = True
+        while not self.closing:
+            try:
+                await self.connect()
+            except Exception as e:
+                self.last_error = str(e)
+                self.connected = False
+                logging.warning('AMI connect failed. Trying again in %ss. %s', delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
+                first = False
+                continue
+
+            delay = 1
+            if not first:
+                self.reconnects += 1
+                await self.resync()
+            first = False
+
+            while not self.closing:
+                await asyncio.sleep(self.interval)
+                if self.protocol.closed.done():
+                    self.last_error = 'connection closed'
+                    break
+                sent = self.loop.time()
+                response = await self.request('Ping')
+                if response is not None:
+                    app.ami_latency['ping'].record(self.loop.time() - sent)
+                if response is None or response.is_error():
+                    self.last_error = 'no answer to Ping'
+                    break
+            self.connected = False
+            if not self.closing:
+                logging.warning('Lost AMI connection: %s', self.last_error)
+            self.protocol.transport.close()
+            for future in self.futures.values():
+                future.abandon()
+            self.futures.clear()
+
+    def logoff(self):
+        self.closing = True
+        if self.connected:
+            self.send('Logoff')
+
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        return dict([
+            ('connected', self.connected),
+            ('reconnects', self.reconnects),
+            ('resyncs', self.resyncs),
+            ('last_error', self.last_error),
+            ])
@@ -17,6 +17,61 @@ def read_status():
             "Failed to get status. Probably an issue with panel_gen",
         )
 
+def read_stats():
+    """
+    GET /app/stats
+    Success:    Returns 200 OK + internal performance counters
+    Failure:    Returns 500
+    """
+    try:
+        return panel_gen.get_stats()
+    except Exception as e:
+        abort(
+            500,
+            "Failed to get stats. Check get_stats()",
+        )
+
+def read_stress():
+    """
+    GET /app/stress
+    Success:    Returns 200 OK + results of the latest stress test
+    Failure:    Returns 404 if there hasn't been one
+    """
+    result = panel_gen.get_stress()
+    if result != False:
+        return result
+    else:
+        abort(
+            404,
+            "No stress test has been run.",
+        )
+
+def start_stress(**kwargs):
+    """
+    POST /app/stress/{switch}
+    Success:    Returns 200 OK + starts a stress test on {switch}.
+                Poll GET /app/stress for how it's going.
+    Failure:    Returns 406
+
+    **kwargs allow the POST to be parsed for specifics
+    switch:     In URI path. Can be "1xb", "5xb", "panel"
+    step, interval, max_lines:  In URI query string. Optional.
+    """
+    try:
+        result = panel_gen.api_stress(**kwargs)
+    except Exception as e:
+        abort(
+            500,
+            "Failed to start stress test. Check api_stress()",
+        )
+    if result != False:
+        return result
+    else:
+        abort(
+            406,
+            "Couldn't start a stress test. Is another one still going, or is that not a switch we originate on?",
+        )
+
 def start(**kwargs):
     """
     POST /app/start/{switch}
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  Times panel_gen's hot paths with 10 up to 10,000 lines, on the     #
+#  simulation stand-ins, so there's no Asterisk involved. Results go  #
+#  to a JSON file, so two releases can be run on the same box and     #
+#  compared.                                                          #
+#                                                                     #
+#    python panel_gen.py -bench bench.json                            #
+#    python panel_gen.py -bench - -o 5xb -benchlines 100,1000         #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+from time import perf_counter
+from datetime import datetime
+import sys
+import uuid
+import json
+import logging
+import platform
+import numpy
+from tabulate import tabulate
+
+from simulation import sim_engine, sim_scheduler_kind
+import panel_gen as app
+
+BENCH_LINES = [10, 100, 1000, 10000]
+
+
+def bench_lines(n):
+    """
+    A fresh simulated engine with n lines, dealt out evenly over the
+    originating switches. Nothing is on a call yet.
+    """
+    sim_engine()
+    lines = app.lines
+    switches = app.originating_switches
+    for i in range(n):
+        lines.add(lines.new(switches[i % len(switches)]))
+    return list(lines)
+
+
+def bench_time(fn, items, reps, setup=None):
+    """
+    Calls fn on every item, reps times over. Returns the best and
+    median seconds per call.
+
+    setup:      If given, called before every rep, outside the timing,
+                to make a fresh list of items.
+    """
+    times = []
+    for r in range(reps):
+        if setup is not None:
+            items = setup()
+        started = perf_counter()
+        for i in items:
+            fn(i)
+        times.append((perf_counter() - started) / len(items))
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def bench_tick(n, reps):
+    def idle():
+        # Timer a long way off. What almost every tick looks like.
+        items = bench_lines(n)
+        for l in items:
+            l.timer = 3600
+        return items
+
+    def due():
+        # Timer just ran out, so every line tries to call. Past a few
+        # dozen lines, most of them find the senders busy and park.
+        items = bench_lines(n)
+        for l in items:
+            l.timer = 0
+        return items
+
+    return [('tick_idle', 'line') + bench_time(app.Line.tick, None, reps, idle),
+            ('tick_due', 'line') + bench_time(app.Line.tick, None, reps, due)]
+
+
+def bench_picks(n, reps):
+    items = bench_lines(n)
+
+    def newchannel(l):
+        l.switch.newchannel(l)
+        l.switch.freechannel(l)
+
+    return [('pick_next_called', 'line') +
+                bench_time(lambda l: l.pick_next_called(app.term_choices), items, reps),
+            ('newtimer', 'line') + bench_time(lambda l: l.switch.newtimer(), items, reps),
+            ('newchannel', 'line') + bench_time(newchannel, items, reps)]
+
+
+def bench_safetynet(n, reps):
+    bench_lines(n)
+    return [('safetynet', 'call') + bench_time(lambda i: app.safetynet(), range(100), reps)]
+
+
+def bench_events(n, reps):
+    """
+    Every line gets a DialBegin, then a DialEnd, then a Hangup, the
+    way Asterisk would send them, made up on the spot. Each handler is
+    timed on its own pass.
+    """
+    items = bench_lines(n)
+    times = dict((name, []) for name in app.ami_dispatch)
+
+    for r in range(reps):
+        calls = []
+        for l in items:
+            l.magictoken = str(uuid.uuid4())
+            l.pending_call = True
+            calls.append((l.magictoken, str(l.ident)))
+
+        for name in ('DialBegin', 'DialEnd', 'Hangup'):
+            events = [app.CallEvent(name, token, chan) for token, chan in calls]
+            handler = app.ami_dispatch[name]
+            started = perf_counter()
+            for e in events:
+                handler(e)
+            times[name].append((perf_counter() - started) / n)
+            # DialEnd leaves the rest of its work on the timer.
+            app.t_timer.run_due()
+
+    results = []
+    for name in ('DialBegin', 'DialEnd', 'Hangup'):
+        t = sorted(times[name])
+        results.append(('on_' + name, 'event', t[0], t[len(t) // 2]))
+    return results
+
+
+def bench_dumps(n, reps):
+    bench_lines(n)
+    return [('get_all_lines', 'call') + bench_time(lambda i: app.get_all_lines(), [0], reps),
+            ('get_all_switches', 'call') +
+                bench_time(lambda i: app.get_all_switches(), [0], reps)]
+
+
+BENCHMARKS = [bench_tick, bench_picks, bench_safetynet, bench_events, bench_dumps]
+
+
+def run_benchmarks(reps=5):
+    """
+    What -bench does. Runs every benchmark at every line count, prints
+    a table of median microseconds, and writes all the numbers as JSON
+    to the file named by -bench, or stdout for "-".
+    """
+    args = app.args
+
+    # Timing the code, not the disk.
+    logging.getLogger().setLevel(logging.ERROR)
+
+    # Spread the lines over more than one switch, unless told otherwise.
+    if args.o == []:
+        args.o = ['all']
+
+    if args.benchlines is None:
+        counts = BENCH_LINES
+    else:
+        counts = [int(n) for n in args.benchlines.split(',')]
+
+    results = []
+    for n in counts:
+        for bench in BENCHMARKS:
+            for name, per, best, median in bench(n, reps):
+                results.append(dict([
+                    ('bench', name),
+                    ('lines', n),
+                    ('per', per),
+                    ('best_us', best * 1e6),
+                    ('median_us', median * 1e6),
+                    ]))
+
+    report = dict([
+        ('date', datetime.now().isoformat(timespec='seconds')),
+        ('python', platform.python_version()),
+        ('numpy', numpy.__version__),
+        ('machine', platform.machine()),
+        ('engine', sim_scheduler_kind()),
+        ('switches', [s.kind for s in app.originating_switches]),
+        ('reps', reps),
+        ('results', results),
+        ])
+
+    names = list(dict.fromkeys(r['bench'] for r in results))
+    table = dict(((r['bench'], r['lines']), r['median_us']) for r in results)
+    pers = dict((r['bench'], r['per']) for r in results)
+    print('\nMedian microseconds, with {} lines on {}, {} scheduler.\n'.format(
+        ', '.join(str(n) for n in counts), ', '.join(report['switches']), report['engine']),
+        file=sys.stderr)
+    print(tabulate([[name, pers[name]] + [table[(name, n)] for n in counts] for name in names],
+                   headers=['bench', 'per'] + [str(n) for n in counts],
+                   tablefmt='pipe', floatfmt='.2f'), file=sys.stderr)
+
+    if args.bench == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.bench, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -320,6 +320,9 @@ class Screen():
                 statusbar.addstr(0, int(x/2+15), "ONLINE", curses.color_pair(3))
             else:
                 statusbar.addstr(0, int(x/2+15), "OFFLINE", curses.color_pair(2))
+            if x > 110:
+                statusbar.addstr(0, x-33, "AMI ping:", curses.A_BOLD)
+                statusbar.addstr(0, x-23, ami_ping, curses.A_BOLD)
             statusbar.addstr(0, x-15, "Lines:", curses.A_BOLD)
             statusbar.addstr(0, x-8, str(len(lines)), curses.A_BOLD)
 
@@ -387,6 +390,7 @@ class work_thread(threading.Thread):
         global lines
         global switches
         global server_up
+        global ami_ping
         failcount = 0
 
         while not self.shutdown_flag.is_set():
@@ -408,7 +412,22 @@ class work_thread(threading.Thread):
                 except ValidationError as err:
                     print(err.messages)
                     print(err.valid_data)
-                
+
+                # How fast is Asterisk answering panel_gen?
+                try:
+                    stats = requests.get(APISTATS, timeout=.5).json()
+                    last = stats['latency']['ping']['last']
+                    if stats['ami']['connected'] and last is not None:
+                        ami_ping = '{}ms'.format(int(round(last)))
+                    else:
+                        ami_ping = 'down'
+                except (ValueError, KeyError):
+                    ami_ping = '?'
+                except requests.exceptions.RequestException:
+                    # Lines and switches came back, so the server's up.
+                    # Just don't show a ping this time around.
+                    ami_ping = ''
+
                 server_up = True
                 failcount = 0
                 sleep(1)
@@ -482,9 +501,11 @@ if __name__ == "__main__":
     APILINES = "http://192.168.0.204:5000/api/lines"
     APISWITCH = "http://192.168.0.204:5000/api/switches"
     MUSEUMSTATE = "http://192.168.0.204:5000/api/museum"
+    APISTATS = "http://192.168.0.204:5000/api/app/stats"
     lines = []
     switches = []
     server_up = False
+    ami_ping = '?'
     museum_up = False
     failcount = 0
 
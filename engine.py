@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  The timer and I/O pool that panel_gen's engines are built on.      #
+#                                                                     #
+#  Timer runs callbacks later, like the switching delay between       #
+#  DialEnd and Ringing. Pool runs the slow parts of talking to        #
+#  Asterisk (writing .call files, sending AMI actions) somewhere the  #
+#  main loop doesn't have to wait on them. Both keep the counters     #
+#  that show up in GET /api/app/stats.                                #
+#                                                                     #
+#  timer_thread and io_pool are the threaded engine's. The asyncio    #
+#  engine (aio_engine.py) and the simulation (simulation.py) have     #
+#  their own, built on the same two classes.                          #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+from heapq import heappush, heappop
+import itertools
+import threading
+import logging
+import queue
+
+
+class TimerHandle():
+    """
+    A callback waiting on a timer. Returned by Timer.call_later().
+
+    due:        Time the callback should run, on the timer's clock.
+    callback:   Function to call, with no arguments.
+    owner:      Whatever the callback belongs to, usually a Line.
+    cancelled:  True once cancel() is called. The callback won't run.
+    """
+
+    def __init__(self, due, callback, owner):
+        self.due = due
+        self.callback = callback
+        self.owner = owner
+        self.cancelled = False
+
+    def __repr__(self):
+        return 'TimerHandle(' + repr(self.due) + ', ' + repr(self.owner) + ')'
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timer():
+    """
+    Runs callbacks after a delay. Keeps track of which callbacks belong
+    to whom, so they can all be cancelled together when a line goes
+    away, and how late they ran. Subclasses decide where the callbacks
+    wait: call_later() files them, and fire() runs each one once it's due.
+
+    clock:      Function returning the current time in seconds.
+    lock:       Held while a callback runs. panel_gen's state_lock.
+    cond:       Guards the bookkeeping, and is what timer_thread sleeps on.
+    by_owner:   Dict of owner -> set of its TimerHandles still waiting.
+    """
+
+    def __init__(self, clock, lock):
+        self.clock = clock
+        self.lock = lock
+        self.shutdown_flag = threading.Event()
+        self.cond = threading.Condition(threading.Lock())
+        self.by_owner = {}
+        self.fired = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+    def start(self):
+        pass
+
+    def join(self):
+        pass
+
+    def call_later(self, delay, callback, owner=None):
+        """ Runs callback in delay seconds. Returns its TimerHandle. """
+        raise NotImplementedError
+
+    def pending(self):
+        """ How many callbacks are still waiting. """
+        raise NotImplementedError
+
+    def own(self, handle):
+        # Caller holds cond.
+        if handle.owner is not None:
+            self.by_owner.setdefault(handle.owner, set()).add(handle)
+
+    def cancel_owner(self, owner):
+        """ Cancel every pending callback that belongs to owner. """
+        with self.cond:
+            for handle in self.by_owner.pop(owner, ()):
+                handle.cancel()
+
+    def fire(self, handle):
+        """ Runs a callback that's come due, unless it was cancelled. """
+        with self.cond:
+            owned = self.by_owner.get(handle.owner)
+            if owned is not None:
+                owned.discard(handle)
+                if not owned:
+                    del self.by_owner[handle.owner]
+            if handle.cancelled:
+                return
+            late = self.clock() - handle.due
+            self.fired += 1
+            self.late_total += late
+            self.late_max = max(self.late_max, late)
+
+        try:
+            with self.lock:
+                handle.callback()
+        except Exception as e:
+            logging.exception(e)
+
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        with self.cond:
+            fired = self.fired
+            late_avg = self.late_total / fired if fired else 0.0
+            late_max = self.late_max
+        return dict([
+            ('pending', self.pending()),
+            ('fired', fired),
+            ('late_avg', late_avg),
+            ('late_max', late_max),
+            ])
+
+
+class HeapTimer(Timer):
+    """
+    Timer that keeps its callbacks in a heap, for somebody else to pop
+    as they come due.
+
+    heap:       List of (due, sequence, TimerHandle).
+    """
+
+    def __init__(self, clock, lock):
+        Timer.__init__(self, clock, lock)
+        self.heap = []
+        self.counter = itertools.count()
+
+    def call_later(self, delay, callback, owner=None):
+        handle = TimerHandle(self.clock() + delay, callback, owner)
+        with self.cond:
+            heappush(self.heap, (handle.due, next(self.counter), handle))
+            self.own(handle)
+            if self.heap[0][2] is handle:
+                self.cond.notify()
+        return handle
+
+    def pending(self):
+        with self.cond:
+            return sum(1 for e in self.heap if not e[2].cancelled)
+
+    def next_due(self):
+        """
+        When the first callback is due, or inf if there aren't any.
+        Caller holds cond, unless there's only the one thread.
+        """
+        while self.heap and self.heap[0][2].cancelled:
+            heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return float('inf')
+
+
+class timer_thread(HeapTimer):
+    # One long-lived thread that runs delayed callbacks, like the
+    # switching delay between DialEnd and Ringing. Replaces starting a
+    # new threading.Timer for every event.
+
+    def __init__(self, clock, lock):
+
+        HeapTimer.__init__(self, clock, lock)
+        self.thread = threading.Thread(target=self.run, name='timer_thread', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def join(self):
+        self.thread.join()
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            with self.cond:
+                wait = self.next_due() - self.clock()
+                if wait > 0:
+                    self.cond.wait(min(wait, 1))
+                    continue
+                due, n, handle = heappop(self.heap)
+            self.fire(handle)
+
+
+class Pool():
+    """
+    Runs jobs somewhere the caller doesn't have to wait for them, and
+    keeps score. Subclasses decide where: submit() hands a job off, and
+    whoever ends up running it calls run_job(), or finish() if it ran
+    the job itself.
+
+    clock:      Function returning the current time in seconds.
+    timer:      Timer that a failed job's failed callback runs on.
+    workers:    Threads doing jobs. 0 if there aren't any of our own.
+    """
+
+    workers = 0
+
+    def __init__(self, clock, timer):
+        self.clock = clock
+        self.timer = timer
+        self.shutdown_flag = threading.Event()
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_total = 0.0
+        self.service_max = 0.0
+
+    def start(self):
+        pass
+
+    def join(self):
+        pass
+
+    def submit(self, job, owner=None, failed=None, blocking=True):
+        """
+        Hand off job. If job raises, failed gets run on the timer, with
+        owner's other callbacks. Returns False if there's no room.
+
+        blocking:   True if job can block, like writing a file. Only
+                    the asyncio engine cares.
+        """
+        raise NotImplementedError
+
+    def queued(self):
+        """ Jobs handed off that haven't finished. """
+        return 0
+
+    def run_job(self, queued_at, job, owner, failed):
+        started = self.clock()
+        error = None
+        try:
+            job()
+        except Exception as e:
+            error = e
+        self.finish(queued_at, started, error, owner, failed)
+
+    def finish(self, queued_at, started, error, owner, failed):
+        finished = self.clock()
+        if error is not None:
+            logging.error('I/O job failed: %s', error, exc_info=error)
+            if failed is not None:
+                self.timer.call_later(0, failed, owner)
+
+        with self.lock:
+            self.done += 1
+            if error is not None:
+                self.failed += 1
+            self.wait_total += started - queued_at
+            self.wait_max = max(self.wait_max, started - queued_at)
+            self.service_total += finished - started
+            self.service_max = max(self.service_max, finished - started)
+
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        with self.lock:
+            done = self.done
+            return dict([
+                ('queued', self.queued()),
+                ('workers', self.workers),
+                ('done', done),
+                ('failed', self.failed),
+                ('rejected', self.rejected),
+                ('wait_avg', self.wait_total / done if done else 0.0),
+                ('wait_max', self.wait_max),
+                ('service_avg', self.service_total / done if done else 0.0),
+                ('service_max', self.service_max),
+                ])
+
+
+class io_pool(Pool):
+    # A few threads that do the slow parts of talking to Asterisk:
+    # writing .call files and sending AMI actions. work_thread puts
+    # jobs on a bounded queue and gets back to its timers. If the
+    # queue is full, submit() says so instead of waiting.
+
+    def __init__(self, clock, timer, workers=2, size=64):
+
+        Pool.__init__(self, clock, timer)
+        self.jobs = queue.Queue(maxsize=size)
+        self.workers = workers
+        self.threads = [threading.Thread(target=self.run, name='io_pool-{}'.format(i),
+                                         daemon=True)
+                        for i in range(workers)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+
+    def submit(self, job, owner=None, failed=None, blocking=True):
+        # Every job gets a worker here, blocking or not.
+        try:
+            self.jobs.put_nowait((self.clock(), job, owner, failed))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        return True
+
+    def queued(self):
+        return self.jobs.qsize()
+
+    def run(self):
+        while not self.shutdown_flag.is_set():
+            try:
+                queued_at, job, owner, failed = self.jobs.get(timeout=1)
+            except queue.Empty:
+                continue
+            self.run_job(queued_at, job, owner, failed)
@@ -0,0 +1,379 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  A pretend Asterisk for testing panel_gen without the real thing.   #
+#                                                                     #
+#  Speaks just enough AMI for panel_gen: Login, Logoff, Ping, Events, #
+#  Filter, CoreStatus, CoreShowChannels, Hangup and Originate.        #
+#  Also eats .call files out of the spool directory like Asterisk     #
+#  does, and plays out each call with DialBegin, DialEnd and Hangup   #
+#  events carrying panel_gen's magic token as the accountcode.        #
+#                                                                     #
+#  Point the [ami] section of /etc/panel_gen.conf at it.              #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+import os
+import re
+import sys
+import random
+import asyncio
+import logging
+import argparse
+from configparser import ConfigParser
+
+# How long a sender takes to pulse out the digits (DialBegin to
+# DialEnd), by originating switch. Rough numbers from watching the
+# real ones.
+DIAL_TIMES = {
+    'panel':    12,
+    '5xb':      8,
+    '1xb':      8,
+    'step':     10,
+    '3ess':     4,
+    }
+
+# How long the called line rings before we give up and hang up on
+# our own, by switch. 0 means ring until waittime runs out, which is
+# what the sarah_callsim context does.
+RING_TIMES = {}
+
+# Seconds from spooling or Originate to DialBegin.
+SEIZE_TIME = 0.5
+
+# Everything above is nudged by up to this much either way, so calls
+# don't all move in lockstep.
+JITTER = 0.2
+
+
+class Call():
+    """
+    One call in progress.
+
+    chan:       DAHDI channel number, as a string.
+    token:      The accountcode panel_gen gave us.
+    kind:       Originating switch, from the caller ID.
+    waittime:   How long the dialplan would keep the call up.
+    task:       asyncio task playing out the call.
+    """
+
+    def __init__(self, chan, token, kind, waittime):
+        self.chan = chan
+        self.token = token
+        self.kind = kind
+        self.waittime = waittime
+        self.task = None
+
+    def __repr__(self):
+        return 'Call({!r}, {!r}, {!r})'.format(self.chan, self.token, self.kind)
+
+
+class Session():
+    """ One AMI connection. Events only go to sessions that want them. """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.authed = False
+        self.events = True
+
+    def send(self, pack):
+        if self.writer.is_closing():
+            return
+        data = ''.join('{}: {}\r\n'.format(k, v) for k, v in pack) + '\r\n'
+        self.writer.write(data.encode('utf-8'))
+
+
+class MockAsterisk():
+    """
+    The whole fake Asterisk. Tracks calls by channel, and tells every
+    listening AMI session about them.
+
+    calls:      Dict of channel -> Call.
+    sessions:   Set of connected Sessions.
+    """
+
+    def __init__(self, user=None, secret=None, spool_dir='/var/spool/asterisk/outgoing'):
+        self.user = user
+        self.secret = secret
+        self.spool_dir = spool_dir
+        self.calls = {}
+        self.sessions = set()
+        self.started = 0
+        self.finished = 0
+        self.busy = 0
+        self.sent = 0
+
+    def jitter(self, seconds):
+        return max(0, seconds * random.uniform(1 - JITTER, 1 + JITTER))
+
+    def event(self, name, *keys):
+        pack = [('Event', name), ('Privilege', 'call,all')] + list(keys)
+        for s in list(self.sessions):
+            if s.authed and s.events:
+                s.send(pack)
+                self.sent += 1
+
+    # Calls
+
+    def originate(self, channel, token, callerid, waittime):
+        """
+        Starts a call, the way Asterisk would from a .call file or an
+        Originate. Returns False if the channel is already busy.
+        """
+        m = re.match(r'DAHDI/(\d+)', channel)
+        if m is None:
+            logging.warning('Not a DAHDI channel: %s', channel)
+            return False
+        chan = m.group(1)
+        if chan in self.calls:
+            # Real Asterisk would fail the call, and panel_gen would
+            # time out waiting for DialBegin.
+            self.busy += 1
+            logging.info('DAHDI/%s is busy. Dropping call %s', chan, token)
+            return False
+
+        m = re.search(r'<(.*)>', callerid or '')
+        kind = m.group(1) if m else ''
+        call = Call(chan, token, kind, waittime)
+        self.calls[chan] = call
+        self.started += 1
+        call.task = asyncio.ensure_future(self.play(call))
+        return True
+
+    async def play(self, call):
+        dest = 'DAHDI/{}-1'.format(call.chan)
+        try:
+            await asyncio.sleep(self.jitter(SEIZE_TIME))
+            self.event('DialBegin', ('Channel', 'Local/sarah_callsim'),
+                       ('DestChannel', dest), ('DestAccountCode', call.token))
+
+            await asyncio.sleep(self.jitter(DIAL_TIMES.get(call.kind, 8)))
+            self.event('DialEnd', ('Channel', 'Local/sarah_callsim'),
+                       ('DestChannel', dest), ('DestAccountCode', call.token),
+                       ('DialStatus', 'ANSWER'))
+
+            ring = RING_TIMES.get(call.kind, 0)
+            if ring == 0 or ring > call.waittime:
+                ring = call.waittime
+            await asyncio.sleep(self.jitter(ring))
+        except asyncio.CancelledError:
+            pass
+        self.hangup(call.chan)
+
+    def hangup(self, chan):
+        call = self.calls.pop(chan, None)
+        if call is None:
+            return False
+        if call.task is not None and call.task is not asyncio.current_task():
+            call.task.cancel()
+        self.finished += 1
+        self.event('Hangup', ('Channel', 'DAHDI/{}-1'.format(chan)),
+                   ('AccountCode', call.token), ('Cause', '16'))
+        return True
+
+    # Spool
+
+    async def watch_spool(self, interval=0.05):
+        """ Picks up .call files like Asterisk's pbx_spool does. """
+        while True:
+            try:
+                names = [e.name for e in os.scandir(self.spool_dir)
+                         if e.name.endswith('.call') and not e.name.startswith('.')]
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                path = os.path.join(self.spool_dir, name)
+                try:
+                    with open(path) as f:
+                        body = f.read()
+                    os.unlink(path)
+                except OSError:
+                    continue
+                self.spooled(body)
+            await asyncio.sleep(interval)
+
+    def spooled(self, body):
+        keys = {}
+        variables = {}
+        for line in body.splitlines():
+            if ':' not in line:
+                continue
+            k, v = [x.strip() for x in line.split(':', 1)]
+            if k.lower() == 'set' and '=' in v:
+                var, val = v.split('=', 1)
+                variables[var] = val
+            else:
+                keys[k.lower()] = v
+        self.originate(keys.get('channel', ''), keys.get('account', ''),
+                       keys.get('callerid', ''), float(variables.get('waittime', 60)))
+
+    # AMI
+
+    async def serve(self, reader, writer):
+        s = Session(writer)
+        self.sessions.add(s)
+        writer.write(b'Asterisk Call Manager/5.0.1\r\n')
+        try:
+            buf = b''
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data
+                while b'\r\n\r\n' in buf:
+                    pack, buf = buf.split(b'\r\n\r\n', 1)
+                    self.action(s, pack.decode('utf-8', errors='replace'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(s)
+            writer.close()
+
+    def action(self, s, pack):
+        keys = {}
+        variables = {}
+        for line in pack.split('\r\n'):
+            if ': ' not in line:
+                continue
+            k, v = line.split(': ', 1)
+            if k == 'Variable' and '=' in v:
+                var, val = v.split('=', 1)
+                variables[var] = val
+            else:
+                keys[k] = v
+        name = keys.get('Action', '').lower()
+        aid = [('ActionID', keys['ActionID'])] if 'ActionID' in keys else []
+
+        def ok(message, *more):
+            s.send([('Response', 'Success')] + aid + [('Message', message)] + list(more))
+
+        def error(message):
+            s.send([('Response', 'Error')] + aid + [('Message', message)])
+
+        if name == 'login':
+            if self.user is not None and (keys.get('Username') != self.user or
+                                          keys.get('Secret') != self.secret):
+                error('Authentication failed')
+                return
+            s.authed = True
+            ok('Authentication accepted')
+            return
+        if not s.authed:
+            error('Permission denied')
+            return
+
+        if name == 'logoff':
+            s.send([('Response', 'Goodbye')] + aid + [('Message', 'Thanks for all the fish.')])
+            s.writer.close()
+        elif name == 'ping':
+            ok('Pong', ('Ping', 'Pong'))
+        elif name == 'events':
+            s.events = keys.get('EventMask', 'on').lower() not in ('off', 'no', 'false')
+            ok('Events {}'.format('on' if s.events else 'off'))
+        elif name == 'filter':
+            # We only ever send the events panel_gen wants anyway.
+            ok('Filter Added Successfully')
+        elif name == 'corestatus':
+            ok('Core Status', ('CoreCurrentCalls', str(len(self.calls))))
+        elif name == 'coreshowchannels':
+            ok('Channels will follow', ('EventList', 'start'))
+            for call in list(self.calls.values()):
+                s.send([('Event', 'CoreShowChannel')] + aid +
+                       [('Channel', 'DAHDI/{}-1'.format(call.chan)),
+                        ('AccountCode', call.token)])
+            s.send([('Event', 'CoreShowChannelsComplete')] + aid +
+                   [('EventList', 'Complete'), ('ListItems', str(len(self.calls)))])
+        elif name == 'hangup':
+            channel = keys.get('Channel', '')
+            if channel.startswith('/') and channel.endswith('/'):
+                # Regex hangup. panel_gen only ever sends match-everything.
+                for chan in list(self.calls):
+                    self.hangup(chan)
+                ok('Channel Hungup')
+                return
+            m = re.match(r'DAHDI/(\d+)-1', channel)
+            if m and self.hangup(m.group(1)):
+                ok('Channel Hungup')
+            else:
+                error('No such channel')
+        elif name == 'originate':
+            if self.originate(keys.get('Channel', ''), keys.get('Account', ''),
+                              keys.get('CallerID', ''),
+                              float(variables.get('waittime', 60))):
+                ok('Originate successfully queued')
+            else:
+                error('Originate failed')
+        else:
+            error('Invalid/unknown command')
+
+    async def report(self, every):
+        while True:
+            await asyncio.sleep(every)
+            logging.info('calls up: %s, started: %s, finished: %s, busy: %s, '
+                         'events sent: %s, sessions: %s', len(self.calls),
+                         self.started, self.finished, self.busy, self.sent,
+                         len(self.sessions))
+
+
+def parse_times(pairs, into):
+    for pair in pairs or []:
+        try:
+            kind, seconds = pair.split('=', 1)
+            into[kind] = float(seconds)
+        except ValueError:
+            sys.exit('Expected switch=seconds, got {}'.format(pair))
+
+
+def parse_args():
+    config = ConfigParser()
+    config.read('/etc/panel_gen.conf')
+
+    parser = argparse.ArgumentParser(description='Pretend to be Asterisk, for testing panel_gen. '
+            'Listens for AMI where [ami] in /etc/panel_gen.conf says, and watches the spool.')
+    parser.add_argument('-p', metavar='port', type=int,
+            default=config.getint('ami', 'port', fallback=5038),
+            help='AMI port to listen on. Defaults to the one in panel_gen.conf.')
+    parser.add_argument('-s', metavar='dir',
+            default=config.get('spool', 'spool_dir', fallback='/var/spool/asterisk/outgoing'),
+            help='Spool directory to watch for .call files.')
+    parser.add_argument('-d', metavar='switch=seconds', action='append',
+            help='Dial time for a switch, DialBegin to DialEnd. Can be given more than once.')
+    parser.add_argument('-r', metavar='switch=seconds', action='append',
+            help='How long calls from a switch ring before we hang up. '
+            'Defaults to the waittime panel_gen sends.')
+    parser.add_argument('-i', metavar='seconds', type=float, default=10,
+            help='Seconds between status reports.')
+    parser.add_argument('-n', action='store_true',
+            help='Accept any AMI username and secret.')
+    args = parser.parse_args()
+
+    parse_times(args.d, DIAL_TIMES)
+    parse_times(args.r, RING_TIMES)
+
+    if args.n:
+        user, secret = None, None
+    else:
+        user = config.get('ami', 'user', fallback=None)
+        secret = config.get('ami', 'secret', fallback=None)
+    return args, user, secret
+
+
+async def main(args, user, secret):
+    mock = MockAsterisk(user, secret, args.s)
+    server = await asyncio.start_server(mock.serve, '127.0.0.1', args.p)
+    logging.info('Mock Asterisk listening on port %s, watching %s', args.p, args.s)
+    asyncio.ensure_future(mock.watch_spool())
+    asyncio.ensure_future(mock.report(args.i))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+            level=logging.INFO, datefmt='%m/%d/%Y %I:%M:%S %p')
+    args, user, secret = parse_args()
+    try:
+        asyncio.run(main(args, user, secret))
+    except KeyboardInterrupt:
+        pass
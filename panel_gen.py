@@ -10,24 +10,62 @@
 #                                                                     #
 #---------------------------------------------------------------------#
 
-from time import sleep
-from os import system
+from time import sleep, monotonic, perf_counter
+from heapq import heappush, heappop, heapify
+import itertools
+import gzip
+import os
+import errno
+import shutil
+import weakref
 import signal
 import subprocess
 import argparse
 import logging
 import uuid
 import curses
-import re
 import threading
 import sys
+from collections import namedtuple, deque
+from functools import partial
 from configparser import ConfigParser
 from datetime import datetime
 from marshmallow import Schema, fields, post_load
 from tabulate import tabulate
+import numpy
 from numpy import random
-from pycall import CallFile, Call, Application, Context
 from asterisk.ami import AMIClient, EventListener, AMIClientAdapter
+from engine import timer_thread, io_pool
+
+# The engines and harnesses in aio_engine.py, simulation.py, bench.py
+# and replay.py get at us with "import panel_gen". When we're run as a
+# script we're __main__, so point that name here, or they'd get a whole
+# second copy of panel_gen.
+sys.modules.setdefault('panel_gen', sys.modules[__name__])
+
+
+def counted(name, *counters):
+    """
+    Makes a property for a True/False flag on Line, that keeps a count
+    on the line's switch of how many lines have the flag set. That way
+    nobody has to loop over every line to find out.
+
+    name:       Name of the flag.
+    counters:   Names of the counter attributes on Switch.
+    """
+    attr = '_' + name
+
+    def get(self):
+        return getattr(self, attr, False)
+
+    def set(self, value):
+        if value != getattr(self, attr, False):
+            setattr(self, attr, value)
+            step = 1 if value else -1
+            for counter in counters:
+                setattr(self.switch, counter, getattr(self.switch, counter) + step)
+
+    return property(get, set)
 
 
 class Line():
@@ -41,6 +79,7 @@ class Line():
     term:               String containing the 7-digit terminating line.
     timer:              Starts with a standard random.gamma, then gets set
                         subsequently by the call volume attribute of the switch.
+                        Stored as a monotonic deadline; see Scheduler.
     ident:              Integer starting with 0 that identifies the line.
     human_term:         Easily readable called line number, for my dyslexic ass.
     chan:               DAHDI channel the call is being placed on.
@@ -50,107 +89,196 @@ class Line():
     ast_status:         Returned from AMI. Indicates status of line from
                         Asterisk's perspective.
     ami_tmr:            Set when we ask Asterisk to do something. Number of seconds to wait
-                        before we expect an AMI event response.
+                        before we expect an AMI event response. Also stored
+                        as a deadline.
     switching_delay:    Set when a call is made that requires extra time in the dialing
                         state, such as a call via ANI trunks.
     pending_*           Set to true if this line is pending action by Asterisk.
                         Set to false when Asterisk confirms it took action.
+    scheduled:          False once the line has been destroyed, so the
+                        scheduler stops waking it up.
+    registry:           LineRegistry this line belongs to. Changing chan or
+                        magictoken keeps the registry's indexes up to date.
+    dispatched_at:      When call() handed the current call to the dispatcher.
+                        Used to time how long Asterisk takes to DialBegin.
+    waiting:            True while the line is parked in its switch's
+                        admission queue, waiting for a sender or channel.
+    reserved_chan:      DAHDI channel we picked for the current call. Held
+                        from the moment call() picks it until Asterisk
+                        reports a hangup or we give up waiting.
     """
 
     def __init__(self, ident, switch, **kwargs):
         self.switch = switch
         self.kind = switch.kind
+        self.registry = None
         self.status = 0
         self.term = self.pick_next_called(term_choices)
-        self.timer = random.gamma(3,4)
         self.ident = ident
-        self.human_term = phone_format(self.term)
         self.chan = '-'
+        self.reserved_chan = None
         self.magictoken = ""
         self.ast_status = 'on_hook'
-        self.ami_tmr = 0
         self.switching_delay = 0
         self.longdistance = False
         self.pending_call = False
         self.pending_dialend = False
         self.pending_hangup = False
+        self.waiting = False
+        self.waiting_since = 0
+        self.dispatched_at = None
+        self.scheduled = True
+        self.ami_deadline = scheduler.now()
+        self.deadline = self.ami_deadline
+        self.timer = random.gamma(3,4)
 
     def __repr__(self):
         return 'Line('+ repr(self.ident) + ', ' + repr(self.term) +')'
 
+    longdistance = counted('longdistance', 'ld_calls')
+    pending_call = counted('pending_call', 'pending', 'originating')
+    pending_dialend = counted('pending_dialend', 'pending')
+    pending_hangup = counted('pending_hangup', 'pending')
+
+    @property
+    def chan(self):
+        return self._chan
+
+    @chan.setter
+    def chan(self, chan):
+        if self.registry is not None:
+            self.registry.reindex(self.registry.by_chan, self, self.chan, chan)
+        self._chan = chan
+
+    @property
+    def magictoken(self):
+        return self._magictoken
+
+    @magictoken.setter
+    def magictoken(self, token):
+        if self.registry is not None:
+            self.registry.reindex(self.registry.by_token, self, self.magictoken, token)
+        self._magictoken = token
+
+    @property
+    def timer(self):
+        return self.deadline - scheduler.now()
+
+    @timer.setter
+    def timer(self, seconds):
+        self.deadline = scheduler.now() + seconds
+        scheduler.reschedule(self)
+
+    @property
+    def ami_tmr(self):
+        return self.ami_deadline - scheduler.now()
+
+    @ami_tmr.setter
+    def ami_tmr(self, seconds):
+        self.ami_deadline = scheduler.now() + seconds
+        scheduler.reschedule(self)
+
+    def next_deadline(self):
+        """
+        Returns the monotonic time at which this line next needs
+        attention: either its call timer runs out, or we give up
+        waiting on Asterisk.
+        """
+        now = scheduler.now()
+        deadline = self.deadline
+        if self.waiting:
+            # Parked in the switch's admission queue. Switch.admit()
+            # wakes us up when there's a sender free.
+            deadline = float('inf')
+        elif self.pending_hangup and deadline <= now:
+            # Timer already ran out. Nothing to do until Asterisk
+            # confirms the hangup, or fails to.
+            deadline = self.ami_deadline
+        if self.ami_deadline > now:
+            deadline = min(deadline, self.ami_deadline)
+        return deadline
+
     def tick(self):
         """
-        Decrement line timer.
+        Called by the work thread when this line's deadline comes due.
         Manages the line's state machine by placing calls or hanging up,
         depending on status.
 
         Returns the new value of self.timer
         """
         try:
+            if self.scheduled == False:
+                return self.timer
             if self.switch.running == False:
                 self.switch.running = True
-            self.timer -= 0.10
-            self.ami_tmr -= 0.10
-            if self.timer <= 0:
+            self.check_pending()
+            if self.timer <= 0 and self.waiting == False:
                 if self.ast_status == "on_hook":
-                    if self.switch.is_dialing < self.switch.max_dialing:
+                    if self.switch.senders_busy() < self.switch.dial_limit:
                         self.call()
                     else:
-                        # Back off until some calls complete.
-                        self.timer = random.gamma(4,4)
+                        # Wait in line until some calls complete.
                         logging.debug("Hit sender limit: %s with %s calls " +
                             "dialing. Delaying call.",
-                            self.switch.max_dialing, self.switch.is_dialing)
+                            self.switch.dial_limit, self.switch.senders_busy())
+                        self.switch.blocked_senders += 1
+                        self.switch.park(self)
                 elif self.ast_status == "Dialing" or self.ast_status == "Ringing":
-                    self.hangup()
-
-            # Check to make sure we're still sane :)
-            safetynet()
+                    if self.pending_hangup == False:
+                        self.hangup()
 
         except Exception as e:
             logging.exception(e)
 
         return self.timer
 
+    def check_pending(self):
+        """
+        Gives up on Asterisk if it hasn't answered whatever we're
+        waiting for by the time ami_tmr runs out.
+        """
+        def errorhandle(status):
+
+            logging.error("Failed to get AMI %s within allotted time on %s",
+                          status, self)
+            logging.error("Channel: %s", self.chan)
+            logging.error("Status: %s", self.status)
+            logging.error("Asterisk: %s", self.ast_status)
+            logging.error("Term: %s", self.human_term)
+
+        if self.ami_tmr > 0:
+            return
+
+        if self.pending_call == True:
+            self.pending_call = False
+            self.switch.timeouts += 1
+            self.switch.freechannel(self)
+            self.switch.admit()
+            errorhandle("DialBegin")
+
+        if self.pending_dialend == True:
+            self.pending_dialend = False
+            errorhandle("DialEnd")
+
+        if self.pending_hangup == True:
+            self.pending_hangup = False
+            # This pass prevents silly threading confusion where
+            # asterisk will report a hangup before we realize that we've
+            # asked for one ;P
+            if self.chan == '-':
+                pass
+            else:
+                errorhandle("Hangup")
+
     def pick_next_called(self, term_choices):
         """
         Returns a string containing a 7-digit number to call.
+        Also sets human_term to match.
 
         term_choices:       List of office codes. Comes from config file
         """
-        if len(NXX) != len(self.switch.trunk_load):
-            logging.error("Check your config file! \"nxx\" is of a length %s " +
-                        "and the trunk load of %s switch is %s",
-                        len(NXX), self.switch.kind, len(self.switch.trunk_load))
-            logging.error("Also check the switch class for the presence of each " +
-                        "trunk load variable that exists in config file.")
-
-        if term_choices == []:
-            term_office = random.choice(NXX, p=self.switch.trunk_load)
-        else:
-            term_office = random.choice(term_choices)
-
-        # Choose a sane number that appears on the line link or final
-        # frame of the switches that we're actually calling. If something's
-        # wrong, then assert false, so it will get caught.
-
-        if term_office == 722 or term_office == 365:
-            term_station = random.randint(Rainier.line_range[0], Rainier.line_range[1])
-        elif term_office == 832 or term_office == 833 or term_office == 524:
-            term_station = random.choice(Lakeview.line_range)
-        elif term_office == 232:
-            term_station = random.choice(Adams.line_range)
-        elif term_office == 275:
-            term_station = random.randint(Step.line_range[0], Step.line_range[1])
-        elif term_office == 830:
-            term_station = random.randint(ESS3.line_range[0], ESS3.line_range[1])
-        else:
-            logging.error("No terminating line available for this office.")
-            assert False
-
-        term = str(term_office) + str(term_station)
+        term, self.human_term = self.switch.nextterm(term_choices)
         logging.debug('Terminating line selected: %s', term)
-        self.human_term = phone_format(term)
         return term
 
 
@@ -164,9 +292,9 @@ class Line():
             timer:           duration of the call
 
         """
-        nextchan = self.switch.newchannel(self.switch.channel_choices)
+        nextchan = self.switch.newchannel(self)
         if nextchan == False:
-            self.timer = random.gamma(4,4)
+            self.switch.park(self)
             return
 
         pred = ''
@@ -195,19 +323,35 @@ class Line():
         self.ami_tmr = 4
         self.pending_call = True
 
-        logging.debug('About to create .call file for line %s', self.ident)
+        logging.debug('About to dispatch call for line %s', self.ident)
         logging.debug('Magic Token: %s', self.magictoken)
 
-        # Make the .call file amd throw it into the asterisk spool.
+        # Hand the call to Asterisk, by whichever method is configured.
         # Pass control of the call to the sarah_callsim context in
         # the dialplan.
         # Set accountcode to our magic UUID for use later.
-        c = Call(channel, variables=vars, callerid=cid,
-                 account=self.magictoken)
-        con = Context('sarah_callsim', pred+self.term, '1')
-        cf = CallFile(c, con)
-        cf.spool()
-
+        # The actual disk or socket work happens on the I/O pool, so a
+        # slow spool doesn't hold up everybody else's timers.
+        self.dispatched_at = scheduler.now()
+        job = partial(dispatcher.originate, channel, pred+self.term, vars, cid,
+                      account=self.magictoken)
+        if not t_io.submit(job, owner=self, failed=self.dispatch_failed,
+                           blocking=dispatcher.blocking):
+            self.dispatch_failed()
+
+    def dispatch_failed(self):
+        """
+        The call never made it to Asterisk, either because the I/O
+        queue was full or the dispatcher blew up. Give the channel
+        back and try again in a second.
+        """
+        if self.pending_call == False:
+            return
+        logging.warning('Could not dispatch call on line %s', self.ident)
+        self.pending_call = False
+        self.switch.freechannel(self)
+        self.timer = 1
+        self.switch.admit()
 
 
     def hangup(self):
@@ -219,7 +363,11 @@ class Line():
         Response is handled in on_Hangup()
         """
 
-        adapter.Hangup(Channel='DAHDI/{}-1'.format(self.chan))
+        job = partial(timed_action, 'hangup', 'Hangup', Channel='DAHDI/{}-1'.format(self.chan))
+        if not t_io.submit(job, owner=self):
+            # I/O queue is full. Timer's still expired, so tick() will
+            # have another go.
+            return
         self.pending_hangup = True
         self.ami_tmr = 3
         logging.debug('2: Asked Asterisk to hangup %s on DAHDI/%s, line %s',
@@ -238,7 +386,27 @@ class Switch():
     running:        Whether or not switch is running.
     max_dialing:    Set based on sender capacity.
     is_dialing:     Records current number of calls in Dialing state.
+    on_call:        Number of lines off hook.
+    ld_calls:       Number of lines on a long distance (ANI) call.
+    pending:        Number of things we're waiting on Asterisk for.
+    originating:    Number of calls spooled that Asterisk hasn't sent a
+                    DialBegin for yet. These are about to grab a sender.
+                    The last three are kept up to date by Line itself.
+    waiting:        Admission queue. Deque of lines that are due to place
+                    a call, but found every sender or channel busy.
+    throttle:       Cap on calls dialing at once, set by the backpressure
+                    controller when Asterisk is struggling. None if we're
+                    not being held back.
+    dial_limit:     The lower of max_dialing and throttle.
+    timeouts:       How many times Asterisk never sent a DialBegin.
+    blocked_*:      How many times a line was due to call but had to wait,
+                    because every sender was busy, or every channel.
+    dialed:         DialBegins for calls we placed.
+    dial_latency:   Total seconds from placing those calls to DialBegin.
+    completed:      DialEnds for calls we placed, i.e. calls the switch
+                    finished dialing.
     dahdi_group:    Passed to Asterisk when call is made.
+    channels:       ChannelAllocator for the channels in channel_choices.
     traffic_load:   String that contains "light", "heavy", or "normal".
                     Sets the random.gamma distribution for generating
                     new call timers.
@@ -247,7 +415,13 @@ class Switch():
     max_nxx:        Values for trunk load. Determined by how many
                     outgoing trunks we have provisioned on the switch.
     trunk_load:     List of max_nxx used to compute load on trunks.
+                    Setting it throws away any numbers already picked.
+    terms:          Prefetch pool of (term, human_term) picked by a
+                    TermSampler. Built the first time we need a number.
     line_range:     Range of acceptable lines to dial when calling this office.
+    n_ga, h_ga:     Normal and heavy gamma parameters, as strings from config.
+    gammas:         Dict of traffic_load -> (k, theta), parsed from the above.
+    timers:         Dict of traffic_load -> Prefetch pool of call timers.
     """
 
     def __init__(self, **kwargs):
@@ -257,8 +431,24 @@ class Switch():
         self.max_dialing = config.getint(kind, 'max_dialing')
         self.is_dialing = 0
         self.on_call = 0
+        self.ld_calls = 0
+        self.pending = 0
+        self.originating = 0
+        self.waiting = deque()
+        self.throttle = None
+        self.timeouts = 0
+        self.blocked_senders = 0
+        self.blocked_channels = 0
+        self.dialed = 0
+        self.dial_latency = 0.0
+        self.completed = 0
+        self.admission_lock = threading.Lock()
+        self.admitted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
         self.dahdi_group = config.get(kind, 'dahdi_group')
         self.channel_choices = config.get(kind, 'channels').split(",")
+        self.channels = ChannelAllocator(self.channel_choices, channels_busy)
         self.ld_capable = config.getboolean(kind, 'long_distance')
         self.traffic_load = "normal"
         self.lines_normal = config.getint(kind, 'lines_normal')
@@ -271,51 +461,1104 @@ class Switch():
         self.max_830 = float(config[kind]['max_830'])
         self.max_833 = float(config[kind]['max_833'])
         self.max_524 = float(config[kind]['max_524'])
+        self.terms = None
         self.trunk_load = [self.max_722, self.max_232,
                 self.max_832, self.max_275, self.max_365,
                 self.max_830, self.max_833, self.max_524]
         self.line_range = config.get(kind, 'line_range').split(",")
-        self.n_ga = config.get(kind, 'n_gamma')
-        self.h_ga = config.get(kind, 'h_gamma')
+        self.load_gamma()
 
     def __repr__(self):
         return 'Switch('+ repr(self.kind) + ')'
 
+    @property
+    def trunk_load(self):
+        return self._trunk_load
+
+    @trunk_load.setter
+    def trunk_load(self, trunk_load):
+        self._trunk_load = trunk_load
+        self.terms = None
+
+    def nextterm(self, term_choices):
+        """
+        Returns (term, human_term) for the next call placed on this
+        switch. Numbers come out of a pool that is refilled in batches.
+        """
+        if self.terms is None:
+            sampler = TermSampler(self, term_choices)
+            self.terms = Prefetch(sampler.draw)
+        return self.terms.get()
+
+    def load_gamma(self):
+        """
+        Reads the gamma parameters from config and parses them once.
+        Each traffic load gets its own pool of timers, so changing
+        traffic_load just switches which pool newtimer() draws from.
+        Call again after re-reading the config.
+        """
+        self.n_ga = config.get(self.kind, 'n_gamma')
+        self.h_ga = config.get(self.kind, 'h_gamma')
+        self.gammas = {
+            'normal':   tuple(int(x) for x in self.n_ga.split(",")),
+            'heavy':    tuple(int(x) for x in self.h_ga.split(",")),
+            }
+        self.timers = {}
+        for load, (a, b) in self.gammas.items():
+            self.timers[load] = Prefetch(
+                lambda n, a=a, b=b: random.gamma(a, b, size=n).tolist())
+
     def newtimer(self):
         """
-        Returns timer back to Line() object. Checks to see
-        if running as __main__ or as a module and act
-        accordingly.
+        Returns timer back to Line() object, drawn from the pool for
+        the current traffic load.
         """
-        if self.traffic_load == 'heavy':
-            a,b = (int(x) for x in self.h_ga.split(","))
-            timer = random.gamma(a,b)
-        elif self.traffic_load == 'normal':
-            a,b = (int(x) for x in self.n_ga.split(","))
-            timer = random.gamma(a,b)
-        return timer
-
-    def newchannel(self, channel_choices):
+        return self.timers[self.traffic_load].get()
+
+    def newchannel(self, line):
         """
         We can either ask Asterisk to pick a channel, or
         we can do it ourselves. That decision is made in call()
 
-        channel_choices: defined in panel_gen.conf
+        Reserves a channel from channel_choices (defined in panel_gen.conf)
+        for line, and returns it. Returns False if they're all busy.
         """
-        channels_inuse = [l.chan for l in lines]
-        logging.debug('Begin channel selection')
-        logging.debug("In use: %s", channels_inuse)
-        channels_avail = [c for c in channel_choices if not c in channels_inuse]
-        logging.debug("Avail:  %s", channels_avail)
+        self.freechannel(line)
+        nextchan = self.channels.reserve(line)
 
-        if channels_avail == []:
+        if nextchan == False:
+            self.blocked_channels += 1
             logging.warning("No channels available on %s. Not placing call.", self.kind)
             return False
         else:
-            nextchan = random.choice(channels_avail)
-            logging.debug("End channel selection. Selected: %s", nextchan)
+            line.reserved_chan = nextchan
+            logging.debug("Channel selection on %s: %s", self.kind, nextchan)
             return nextchan
 
+    @property
+    def dial_limit(self):
+        if self.throttle is None:
+            return self.max_dialing
+        return min(self.max_dialing, self.throttle)
+
+    def senders_busy(self):
+        """ Senders in use, plus senders about to be in use. """
+        return self.is_dialing + self.originating
+
+    def park(self, line):
+        """
+        Puts a line at the back of the admission queue. It stays there
+        until admit() gets to it.
+        """
+        with self.admission_lock:
+            if line.waiting == False:
+                line.waiting = True
+                line.waiting_since = scheduler.now()
+                self.waiting.append(line)
+        scheduler.reschedule(line)
+
+    def unpark(self, line):
+        """ Takes a line out of the admission queue without admitting it. """
+        with self.admission_lock:
+            if line.waiting == True:
+                line.waiting = False
+                self.waiting.remove(line)
+
+    def admit(self):
+        """
+        Wakes up lines from the front of the admission queue, as many
+        as we have free senders and channels for. Call this whenever a
+        sender or channel might have been freed.
+        """
+        now = scheduler.now()
+        admitted = []
+        with self.admission_lock:
+            room = min(self.dial_limit - self.senders_busy(), self.channels.available())
+            while room > 0 and self.waiting:
+                line = self.waiting.popleft()
+                line.waiting = False
+                wait = now - line.waiting_since
+                self.admitted += 1
+                self.wait_total += wait
+                self.wait_max = max(self.wait_max, wait)
+                admitted.append(line)
+                room -= 1
+
+        for line in admitted:
+            line.timer = 0
+
+    def recount(self):
+        """
+        Rebuilds this switch's counters by looking at every line.
+        Only for when safetynet() finds them in a state that should
+        be impossible.
+        """
+        mine = lines.on_switch(self.kind)
+        self.is_dialing = sum(1 for l in mine if l.ast_status == 'Dialing')
+        self.on_call = sum(1 for l in mine if l.status == 1)
+        self.ld_calls = sum(1 for l in mine if l.longdistance)
+        self.pending = sum(l.pending_call + l.pending_dialend + l.pending_hangup
+                           for l in mine)
+        self.originating = sum(1 for l in mine if l.pending_call)
+
+    def counters(self):
+        """ Returns this switch's counters as a dict. """
+        return dict([
+            ('is_dialing', self.is_dialing),
+            ('on_call', self.on_call),
+            ('ld_calls', self.ld_calls),
+            ('pending', self.pending),
+            ('channels_inuse', self.channels.in_use()),
+            ('waiting', len(self.waiting)),
+            ('admitted', self.admitted),
+            ('wait_avg', self.wait_total / self.admitted if self.admitted else 0.0),
+            ('wait_max', self.wait_max),
+            ('dial_limit', self.dial_limit),
+            ('timeouts', self.timeouts),
+            ('blocked_senders', self.blocked_senders),
+            ('blocked_channels', self.blocked_channels),
+            ])
+
+    def freechannel(self, line):
+        """ Gives back whatever channel line has reserved. """
+        if line.reserved_chan is not None:
+            self.channels.release(line.reserved_chan, line)
+            line.reserved_chan = None
+
+
+class Prefetch():
+    """
+    A pool of precomputed random values.
+
+    Drawing one value at a time from numpy costs microseconds of
+    overhead per call, so we draw a whole block at once and hand the
+    values out one by one. When the pool runs low, the next block is
+    made on the timer thread, off the call path.
+
+    fill:       Function taking n and returning a list of n new values.
+    size:       How many values to make per block.
+    pool:       Deque of values waiting to be handed out.
+    """
+
+    def __init__(self, fill, size=256):
+        self.fill = fill
+        self.size = size
+        self.pool = deque()
+        self.refilling = False
+
+    def get(self):
+        try:
+            value = self.pool.popleft()
+        except IndexError:
+            # Ran dry before the background refill got to it.
+            self.refill()
+            value = self.pool.popleft()
+
+        if len(self.pool) < self.size // 4 and self.refilling == False:
+            self.refilling = True
+            enqueue_event(0, self.refill)
+        return value
+
+    def refill(self):
+        try:
+            self.pool.extend(self.fill(self.size))
+        finally:
+            self.refilling = False
+
+
+class TermSampler():
+    """
+    Picks terminating lines for calls from one switch.
+
+    Offices are weighted by the switch's trunk_load, or evenly across
+    term_choices if those were given on the command line. Weighted
+    picks use Walker's alias method: after building two tables once,
+    each pick is one uniform draw and one comparison, and numpy can do
+    a whole batch of them at once.
+
+    offices:    Array of office codes we can call.
+    prob:       Alias method probability table.
+    alias:      Alias method alias table.
+    """
+
+    def __init__(self, switch, term_choices):
+        if len(NXX) != len(switch.trunk_load):
+            logging.error("Check your config file! \"nxx\" is of a length %s " +
+                        "and the trunk load of %s switch is %s",
+                        len(NXX), switch.kind, len(switch.trunk_load))
+            logging.error("Also check the switch class for the presence of each " +
+                        "trunk load variable that exists in config file.")
+
+        if term_choices == []:
+            self.offices = numpy.array(NXX)
+            weights = numpy.array(switch.trunk_load, dtype=float)
+        else:
+            self.offices = numpy.array(term_choices)
+            weights = numpy.ones(len(term_choices))
+
+        self.prob, self.alias = alias_table(weights / weights.sum())
+
+    def draw(self, n):
+        """ Returns a list of n (term, human_term) tuples. """
+        pick = random.randint(0, len(self.prob), size=n)
+        keep = random.random(n) < self.prob[pick]
+        offices = self.offices[numpy.where(keep, pick, self.alias[pick])]
+
+        terms = numpy.empty(n, dtype=object)
+        for office in numpy.unique(offices):
+            chosen = offices == office
+            stations = term_stations(office, int(chosen.sum()))
+            terms[chosen] = [str(office) + str(st) for st in stations]
+
+        return [(term, phone_format(term)) for term in terms]
+
+
+def alias_table(p):
+    """
+    Builds the tables for Walker's alias method (Vose's version) from
+    a list of probabilities that sum to 1. Returns (prob, alias).
+    """
+    n = len(p)
+    prob = numpy.array(p, dtype=float) * n
+    alias = numpy.zeros(n, dtype=int)
+    small = [i for i in range(n) if prob[i] < 1]
+    large = [i for i in range(n) if prob[i] >= 1]
+
+    while small != [] and large != []:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] -= 1 - prob[s]
+        if prob[l] < 1:
+            small.append(l)
+        else:
+            large.append(l)
+
+    # Whatever's left over is 1, give or take rounding error.
+    for i in small + large:
+        prob[i] = 1
+
+    return prob, alias
+
+
+def term_stations(office, n):
+    """
+    Returns n station numbers to call in an office.
+
+    Choose a sane number that appears on the line link or final
+    frame of the switches that we're actually calling. If something's
+    wrong, then assert false, so it will get caught.
+    """
+    if office == 722 or office == 365:
+        return random.randint(int(Rainier.line_range[0]), int(Rainier.line_range[1]), size=n)
+    elif office == 832 or office == 833 or office == 524:
+        return random.choice(Lakeview.line_range, size=n)
+    elif office == 232:
+        return random.choice(Adams.line_range, size=n)
+    elif office == 275:
+        return random.randint(int(Step.line_range[0]), int(Step.line_range[1]), size=n)
+    elif office == 830:
+        return random.randint(int(ESS3.line_range[0]), int(ESS3.line_range[1]), size=n)
+    else:
+        logging.error("No terminating line available for this office.")
+        assert False
+
+
+# Every DAHDI channel reserved by any switch. See ChannelAllocator.
+channels_busy = {}
+
+
+class ChannelAllocator():
+    """
+    Keeps track of which DAHDI channels a switch can use right now.
+
+    A channel is reserved the moment we pick it for a call, not when
+    Asterisk gets around to telling us about it, so two lines can never
+    pick the same one. Free channels are handed out least recently
+    used first, which spreads the wear around.
+
+    free:       Set of channels nobody has reserved.
+    queue:      Deque of the same channels, oldest release first.
+    busy:       Dict of channel -> line. Shared between every switch's
+                allocator, since a channel can be listed on more than
+                one switch in panel_gen.conf.
+    """
+
+    def __init__(self, channels, busy):
+        self.total = len(channels)
+        self.free = set(channels)
+        self.queue = deque(channels)
+        self.busy = busy
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'ChannelAllocator(' + repr(list(self.queue)) + ')'
+
+    def reserve(self, line):
+        """ Returns the least recently used free channel, or False. """
+        with self.lock:
+            # Skip over anything another switch has grabbed. Each of
+            # those goes to the back of the line, so this only loops
+            # more than once if the config shares channels.
+            for n in range(len(self.queue)):
+                chan = self.queue.popleft()
+                if chan in self.busy:
+                    self.queue.append(chan)
+                    continue
+                self.free.discard(chan)
+                self.busy[chan] = line
+                return chan
+        return False
+
+    def release(self, chan, line):
+        with self.lock:
+            if self.busy.get(chan) is line:
+                del self.busy[chan]
+            if chan not in self.free:
+                self.free.add(chan)
+                self.queue.append(chan)
+
+    def in_use(self):
+        """ Number of this switch's channels that are reserved. """
+        return self.total - len(self.free)
+
+    def take(self, chan, line):
+        """ Reserves a particular channel. Returns False if it isn't free. """
+        with self.lock:
+            if chan not in self.free or chan in self.busy:
+                return False
+            self.free.discard(chan)
+            self.queue.remove(chan)
+            self.busy[chan] = line
+            return chan
+
+    def available(self):
+        """
+        Number of channels reserve() could hand out right now. Not the
+        same as len(free) if another switch is using a shared channel.
+        """
+        with self.lock:
+            return sum(1 for chan in self.free if chan not in self.busy)
+
+
+class LineRegistry():
+    """
+    Holds every active line, with hash indexes for the lookups we do
+    all the time. Iterates in the order lines were added.
+
+    by_ident:       Dict of ident -> line.
+    by_token:       Dict of magictoken -> line. Only lines with a call
+                    in flight have a token.
+    by_chan:        Dict of DAHDI channel -> line. Only lines Asterisk
+                    has reported a channel for.
+    by_switch:      Dict of switch kind -> {line: None}, which is an
+                    insertion-ordered set.
+    """
+
+    def __init__(self):
+        self.by_ident = {}
+        self.by_token = {}
+        self.by_chan = {}
+        self.by_switch = {}
+        self.idents = itertools.count()
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return 'LineRegistry(' + repr(list(self.by_ident.values())) + ')'
+
+    def __iter__(self):
+        # Iterate over a copy, so other threads can add and remove
+        # lines while we're looping.
+        return iter(list(self.by_ident.values()))
+
+    def __len__(self):
+        return len(self.by_ident)
+
+    def __contains__(self, line):
+        return self.by_ident.get(line.ident) is line
+
+    def next_ident(self):
+        """ Hands out an ident that has never been used before. """
+        return next(self.idents)
+
+    def new(self, switch):
+        """
+        Makes a new line on switch with a fresh ident, using whatever
+        kind of Line the scheduler wants. Doesn't add it.
+        """
+        return scheduler.line_class(self.next_ident(), switch)
+
+    def add(self, line):
+        with self.lock:
+            if line.ident in self.by_ident:
+                raise ValueError('Duplicate line ident {}'.format(line.ident))
+            line.registry = self
+            self.by_ident[line.ident] = line
+            self.by_switch.setdefault(line.kind, {})[line] = None
+            if line.magictoken != '':
+                self.by_token[line.magictoken] = line
+            if line.chan != '-':
+                self.by_chan[line.chan] = line
+
+    def extend(self, new_lines):
+        for l in new_lines:
+            self.add(l)
+
+    def remove(self, line):
+        """ Destroys a line. It will never be scheduled again. """
+        with self.lock:
+            if self.by_ident.get(line.ident) is not line:
+                return
+            del self.by_ident[line.ident]
+            del self.by_switch[line.kind][line]
+            if self.by_token.get(line.magictoken) is line:
+                del self.by_token[line.magictoken]
+            if self.by_chan.get(line.chan) is line:
+                del self.by_chan[line.chan]
+            line.registry = None
+        # Take it out of its switch's counts and queue. Nobody's going
+        # to hear about its hangup now, so do what on_Hangup would have.
+        s = line.switch
+        s.unpark(line)
+        if line.ast_status == 'Dialing':
+            s.is_dialing -= 1
+        if line.status == 1:
+            s.on_call -= 1
+        line.status = 0
+        line.ast_status = 'on_hook'
+        line.longdistance = False
+        line.pending_call = False
+        line.pending_dialend = False
+        line.pending_hangup = False
+        s.freechannel(line)
+        scheduler.cancel(line)
+        t_timer.cancel_owner(line)
+        # Might have freed up a sender.
+        s.admit()
+
+    def pop(self, index=-1):
+        """ Removes and returns the newest line, or the oldest if index is 0. """
+        with self.lock:
+            if index == 0:
+                line = next(iter(self.by_ident.values()))
+            else:
+                line = next(reversed(self.by_ident.values()))
+            self.remove(line)
+        return line
+
+    def clear(self):
+        for l in self:
+            self.remove(l)
+
+    def reindex(self, index, line, old, new):
+        # Called by Line when chan or magictoken changes.
+        with self.lock:
+            if index.get(old) is line:
+                del index[old]
+            if new != '' and new != '-':
+                index[new] = line
+
+    def get(self, ident):
+        return self.by_ident.get(ident)
+
+    def by_magictoken(self, token):
+        return self.by_token.get(token)
+
+    def on_switch(self, kind):
+        """ Returns a list of lines originating on a switch. """
+        return list(self.by_switch.get(kind, ()))
+
+    def channel_in_use(self, chan):
+        return chan in self.by_chan
+
+
+lines = LineRegistry()
+
+
+class Scheduler():
+    """
+    Deadline heap for the work thread.
+
+    Every line holds the monotonic time of its next event (a call,
+    a hangup, or giving up on Asterisk). The heap is keyed on those
+    deadlines, so the work thread can sleep until the earliest one
+    instead of polling every line ten times a second.
+
+    Entries are invalidated lazily: rescheduling a line pushes a new
+    entry and blanks out the old one, which gets thrown away when it
+    reaches the top of the heap.
+
+    name:       What it's called under [engine] in panel_gen.conf.
+    clock:      Function returning the current time in seconds.
+    heap:       List of [deadline, sequence, line] entries.
+    entries:    Dict of line -> its live heap entry.
+    """
+
+    name = 'heap'
+    line_class = Line
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.wakeup = threading.Condition(threading.Lock())
+
+    def now(self):
+        return self.clock()
+
+    def reschedule(self, line, not_before=None):
+        """
+        (Re)insert a line at its next deadline. Wakes the work thread
+        if this line is now the first thing due.
+        """
+        if line.scheduled == False:
+            return
+        deadline = line.next_deadline()
+        if not_before is not None and deadline < not_before:
+            deadline = not_before
+        with self.wakeup:
+            old = self.entries.get(line)
+            if old is not None:
+                if old[0] == deadline:
+                    return
+                old[2] = None
+            entry = [deadline, next(self.counter), line]
+            self.entries[line] = entry
+            heappush(self.heap, entry)
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.compact()
+            if self.heap[0] is entry:
+                self.wakeup.notify()
+
+    def cancel(self, line):
+        """
+        Forget about a line that has been destroyed. It will never
+        be scheduled again.
+        """
+        line.scheduled = False
+        with self.wakeup:
+            entry = self.entries.pop(line, None)
+            if entry is not None:
+                entry[2] = None
+
+    def compact(self):
+        # Drop stale entries. Caller holds the lock.
+        self.heap = [e for e in self.heap if e[2] is not None]
+        heapify(self.heap)
+
+    def pop_due(self):
+        """ Returns a list of lines whose deadline has passed. """
+        due = []
+        now = self.now()
+        with self.wakeup:
+            while self.heap and self.heap[0][0] <= now:
+                entry = heappop(self.heap)
+                line = entry[2]
+                if line is not None:
+                    del self.entries[line]
+                    due.append(line)
+        return due
+
+    def wait(self, timeout):
+        """
+        Sleep until the earliest deadline, something new is scheduled
+        ahead of it, or timeout seconds pass.
+        """
+        with self.wakeup:
+            while self.heap and self.heap[0][2] is None:
+                heappop(self.heap)
+            if self.heap:
+                timeout = min(timeout, self.heap[0][0] - self.now())
+            if timeout > 0 and not inbox.queue:
+                self.wakeup.wait(timeout)
+
+    def wake(self):
+        """ Get the work thread up now. AMI events are waiting. """
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def shift(self, seconds):
+        """
+        Push every deadline back. Used after a pause, so timers
+        pick up where they left off.
+        """
+        with self.wakeup:
+            for line, entry in self.entries.items():
+                line.deadline += seconds
+                line.ami_deadline += seconds
+                entry[0] += seconds
+            self.compact()
+            self.wakeup.notify()
+
+
+scheduler = Scheduler()
+
+
+class LineTable():
+    """
+    Struct-of-arrays scheduler for large numbers of lines.
+
+    Does the same job as Scheduler, but keeps the hot part of every
+    line's state in numpy columns, one row per line. Finding what's
+    due is a single vectorized comparison over the whole table instead
+    of heap operations per event, which pays off once we're modeling
+    big virtual switches with thousands of lines.
+
+    Lines made for this table are LineRow objects. They behave just
+    like Line, but read and write their row instead of attributes.
+    Pick this with "scheduler = array" under [engine] in panel_gen.conf.
+
+    rows:           List of row -> weak reference to a LineRow. The
+                    registry owns lines, not us.
+    free_rows:      Rows whose line has been garbage collected, so they
+                    can be handed out again.
+    switches:       List of switch objects. switch_idx indexes into it.
+    deadline:       Column of call timer deadlines.
+    ami_deadline:   Column of AMI timeout deadlines.
+    due:            Column of when each row next needs a tick. inf for
+                    rows that aren't scheduled.
+    earliest:       Earliest deadline in due, or a little before it.
+                    reschedule() only ever lowers it, so it costs nothing
+                    per state change. pop_due() works it out properly.
+    status:         Column of Line.status.
+    ast_code:       Column of Line.ast_status, as an index into AST_STATUS.
+    switch_idx:     Column of which switch each line is on.
+    chan:           Column of DAHDI channels. -1 means none.
+    """
+
+    name = 'array'
+    AST_STATUS = ['on_hook', 'Dialing', 'Ringing']
+
+    def __init__(self, clock=monotonic, size=64):
+        self.clock = clock
+        self.rows = []
+        self.free_rows = []
+        self.switches = []
+        self.wakeup = threading.Condition(threading.Lock())
+        self.earliest = numpy.inf
+        self.deadline = numpy.zeros(size)
+        self.ami_deadline = numpy.zeros(size)
+        self.due = numpy.full(size, numpy.inf)
+        self.status = numpy.zeros(size, dtype=numpy.int8)
+        self.ast_code = numpy.zeros(size, dtype=numpy.int8)
+        self.switch_idx = numpy.zeros(size, dtype=numpy.int16)
+        self.chan = numpy.full(size, -1, dtype=numpy.int16)
+
+    def now(self):
+        return self.clock()
+
+    def allocate(self, line, switch):
+        """ Gives line a row of its own. Returns the row number. """
+        with self.wakeup:
+            if switch not in self.switches:
+                self.switches.append(switch)
+            if self.free_rows != []:
+                row = self.free_rows.pop()
+            else:
+                row = len(self.rows)
+                self.rows.append(None)
+                if row == len(self.due):
+                    self.grow()
+            # The row only goes back on free_rows once the line is
+            # garbage collected. Until then, anything still holding
+            # the line could read or write it. list.append doesn't
+            # need the lock, which matters because the garbage
+            # collector can run while we're holding it.
+            self.rows[row] = weakref.ref(line, lambda ref, row=row: self.free_rows.append(row))
+            self.due[row] = numpy.inf
+            self.chan[row] = -1
+            self.switch_idx[row] = self.switches.index(switch)
+        return row
+
+    def grow(self):
+        # Double every column. Caller holds the lock.
+        n = len(self.due)
+        for name, fill in (('deadline', 0), ('ami_deadline', 0), ('due', numpy.inf),
+                           ('status', 0), ('ast_code', 0), ('switch_idx', 0), ('chan', -1)):
+            old = getattr(self, name)
+            new = numpy.full(2 * n, fill, dtype=old.dtype)
+            new[:n] = old
+            setattr(self, name, new)
+
+    def reschedule(self, line, not_before=None):
+        if line.scheduled == False:
+            return
+        deadline = line.next_deadline()
+        if not_before is not None and deadline < not_before:
+            deadline = not_before
+        with self.wakeup:
+            self.due[line.row] = deadline
+            if deadline < self.earliest:
+                self.earliest = deadline
+                self.wakeup.notify()
+
+    def cancel(self, line):
+        line.scheduled = False
+        with self.wakeup:
+            self.due[line.row] = numpy.inf
+
+    def pop_due(self):
+        now = self.now()
+        with self.wakeup:
+            n = len(self.rows)
+            rows = numpy.flatnonzero(self.due[:n] <= now)
+            self.due[rows] = numpy.inf
+            # Already going over the whole column, so this is the place
+            # to catch earliest up with lines that moved later.
+            self.earliest = self.due[:n].min() if n else numpy.inf
+            due = [self.rows[r]() for r in rows]
+        return [l for l in due if l is not None]
+
+    def wait(self, timeout):
+        with self.wakeup:
+            timeout = min(timeout, self.earliest - self.now())
+            if timeout > 0 and not inbox.queue:
+                self.wakeup.wait(timeout)
+
+    def wake(self):
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def shift(self, seconds):
+        with self.wakeup:
+            n = len(self.rows)
+            self.deadline[:n] += seconds
+            self.ami_deadline[:n] += seconds
+            self.due[:n] += seconds
+            self.earliest += seconds
+            self.wakeup.notify()
+
+    def timers(self):
+        """ Seconds left on every line's call timer, as one array. """
+        with self.wakeup:
+            return self.deadline[:len(self.rows)] - self.now()
+
+
+def column(name, decode=float):
+    """ Makes a property that reads and writes a LineTable column. """
+
+    def get(self):
+        return decode(getattr(self.table, name)[self.row])
+
+    def set(self, value):
+        getattr(self.table, name)[self.row] = value
+
+    return property(get, set)
+
+
+class LineRow(Line):
+    """
+    A Line whose state lives in a row of a LineTable. Everything
+    else about it works exactly like Line.
+
+    table:      The LineTable this line's row is in.
+    row:        Which row.
+    """
+
+    deadline = column('deadline')
+    ami_deadline = column('ami_deadline')
+    status = column('status', int)
+
+    def __init__(self, ident, switch, **kwargs):
+        self.table = scheduler
+        self.row = self.table.allocate(self, switch)
+        Line.__init__(self, ident, switch, **kwargs)
+
+    @property
+    def ast_status(self):
+        return LineTable.AST_STATUS[self.table.ast_code[self.row]]
+
+    @ast_status.setter
+    def ast_status(self, value):
+        self.table.ast_code[self.row] = LineTable.AST_STATUS.index(value)
+
+    @property
+    def _chan(self):
+        chan = self.table.chan[self.row]
+        if chan < 0:
+            return '-'
+        return str(chan)
+
+    @_chan.setter
+    def _chan(self, chan):
+        if chan == '-':
+            self.table.chan[self.row] = -1
+        else:
+            self.table.chan[self.row] = int(chan)
+
+LineTable.line_class = LineRow
+
+
+def make_scheduler():
+    """
+    Picks the scheduler named in the [engine] section of the config.
+    Must be called before any lines are made.
+    """
+    global scheduler
+    kind = config.get('engine', 'scheduler', fallback='heap')
+    if kind == 'array':
+        scheduler = LineTable()
+    elif kind == 'asyncio':
+        from aio_engine import LoopScheduler
+        scheduler = LoopScheduler()
+    elif kind != 'heap':
+        logging.warning("Unknown scheduler %s in config. Using heap.", kind)
+    logging.info('Using %s scheduler', kind)
+
+
+# +-----------------------------------------------+
+# |                                               |
+# |      <----- BEGIN CALL DISPATCH ----->        |
+# |                                               |
+# +-----------------------------------------------+
+
+class Dispatcher():
+    """
+    Base class for the ways we can ask Asterisk to place a call.
+    Pick one with "backend" under [dispatch] in panel_gen.conf.
+
+    Each backend times how long it takes from handing off a call to
+    Asterisk's DialBegin, so they can be compared.
+
+    name:           What to call this backend in stats and logs.
+    blocking:       True if originate() waits on disk or the network.
+    sent:           Number of calls handed off.
+    confirms:       Number of those Asterisk sent a DialBegin for.
+    latency_total:  Sum of seconds from hand off to DialBegin.
+    latency_max:    Longest of those.
+    """
+
+    name = ''
+    blocking = True
+
+    def __init__(self):
+        self.sent = 0
+        self.confirms = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def __repr__(self):
+        return type(self).__name__ + '()'
+
+    def originate(self, channel, exten, variables, callerid, account=None):
+        """
+        Ask Asterisk to call channel, and hand it to exten in the
+        sarah_callsim context once it answers.
+
+        channel:    Asterisk channel, like DAHDI/12/wwww7225555
+        exten:      Extension in sarah_callsim to run.
+        variables:  Dict of channel variables to set.
+        callerid:   Caller ID string.
+        account:    Account code. Asterisk sends it back in every event
+                    about the call, which is how we find the line.
+        """
+        raise NotImplementedError()
+
+    def confirmed(self, latency):
+        """ Called when DialBegin arrives for a call we dispatched. """
+        self.confirms += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def stats(self):
+        return dict([
+            ('backend', self.name),
+            ('sent', self.sent),
+            ('confirms', self.confirms),
+            ('latency_avg', self.latency_total / self.confirms if self.confirms else 0.0),
+            ('latency_max', self.latency_max),
+            ])
+
+
+# Everything in a .call file except the Set: lines is the same shape
+# every time, so format it straight from here.
+CALLFILE_TEMPLATE = (
+    'Channel: {channel}\n'
+    'Callerid: {callerid}\n'
+    '{variables}'
+    'Account: {account}\n'
+    'Context: sarah_callsim\n'
+    'Extension: {exten}\n'
+    'Priority: 1\n'
+    ).format
+
+
+class SpoolWriter():
+    """
+    Puts .call files in the Asterisk spool, and remembers which ones
+    are ours.
+
+    Files get written in the staging directory first, then renamed into
+    the spool, so Asterisk never sees half a file. Keep staging on the
+    same filesystem as the spool (or the rename can't be atomic), and on
+    tmpfs if you can.
+
+    spool_dir:      Where Asterisk looks for .call files.
+    staging_dir:    Where we write them first.
+    ours:           Filenames we've spooled that Asterisk hasn't eaten yet.
+    written:        How many files we've spooled, ever.
+    """
+
+    def __init__(self, spool_dir='/var/spool/asterisk/outgoing',
+                 staging_dir='/var/spool/asterisk/staging'):
+        self.spool_dir = spool_dir
+        self.staging_dir = staging_dir
+        self.ours = set()
+        self.written = 0
+        self.lock = threading.Lock()
+        self.cross_device = False
+
+    def __repr__(self):
+        return ("{}(spool_dir={!r}, staging_dir={!r})").format(
+                type(self).__name__, self.spool_dir, self.staging_dir)
+
+    def render(self, channel, exten, variables, callerid, account):
+        sets = ''.join('Set: %s=%s\n' % (k, v) for k, v in variables.items())
+        return CALLFILE_TEMPLATE(channel=channel, callerid=callerid,
+                                 variables=sets, account=account or '',
+                                 exten=exten)
+
+    def spool(self, body, name=None):
+        """
+        Write body into the spool as a new .call file. Returns the filename.
+        """
+        if name is None:
+            name = str(uuid.uuid4())
+        name = name + '.call'
+        staged = os.path.join(self.staging_dir, name)
+        try:
+            with open(staged, 'w') as f:
+                f.write(body)
+        except FileNotFoundError:
+            os.makedirs(self.staging_dir, exist_ok=True)
+            with open(staged, 'w') as f:
+                f.write(body)
+
+        final = os.path.join(self.spool_dir, name)
+        try:
+            os.rename(staged, final)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Staging is on some other filesystem. Still works, but
+            # Asterisk might catch the file half-copied.
+            if not self.cross_device:
+                logging.warning('Staging dir %s is not on the same filesystem as %s.',
+                                self.staging_dir, self.spool_dir)
+                self.cross_device = True
+            shutil.move(staged, final)
+
+        with self.lock:
+            self.ours.add(name)
+            self.written += 1
+        return name
+
+    def forget(self, name):
+        with self.lock:
+            self.ours.discard(name)
+
+    def depth(self):
+        """
+        How many of our files are still sitting in the spool. Asterisk
+        deletes a .call file once it's done with it, so anything that's
+        gone gets forgotten along the way.
+        """
+        with self.lock:
+            names = list(self.ours)
+        gone = [n for n in names
+                if not os.path.exists(os.path.join(self.spool_dir, n))]
+        with self.lock:
+            self.ours.difference_update(gone)
+            return len(self.ours)
+
+    def cleanup(self):
+        """
+        Delete every .call file we put in the spool that's still there.
+        Leaves everyone else's files alone. Returns how many it deleted.
+        """
+        with self.lock:
+            names = list(self.ours)
+            self.ours.clear()
+        removed = 0
+        for n in names:
+            try:
+                os.unlink(os.path.join(self.spool_dir, n))
+                removed += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warning("Failed to delete %s from spool.", n)
+                logging.warning(e)
+        return removed
+
+    def stats(self):
+        return dict([
+            ('depth', self.depth()),
+            ('written', self.written),
+            ])
+
+
+spool = SpoolWriter()
+
+
+class CallFileDispatcher(Dispatcher):
+    """
+    Make a .call file and throw it into the asterisk spool. Asterisk
+    picks it up from /var/spool/asterisk/outgoing.
+    """
+
+    name = 'callfile'
+
+    def originate(self, channel, exten, variables, callerid, account=None):
+        body = spool.render(channel, exten, variables, callerid, account)
+        spool.spool(body, account)
+        self.sent += 1
+
+
+class OriginateDispatcher(Dispatcher):
+    """
+    Send an AMI Originate action over the AMI connection we already
+    have. Async, so we don't wait around for the call to be answered.
+    """
+
+    name = 'originate'
+    blocking = False
+
+    def originate(self, channel, exten, variables, callerid, account=None):
+        keys = dict([
+            ('Channel', channel),
+            ('Context', 'sarah_callsim'),
+            ('Exten', exten),
+            ('Priority', '1'),
+            ('CallerID', callerid),
+            ('Async', 'true'),
+            ])
+        if account is not None:
+            keys['Account'] = account
+        timed_action('originate', 'Originate', variables=variables, **keys)
+        self.sent += 1
+
+
+dispatcher = CallFileDispatcher()
+
+
+def make_dispatcher():
+    """
+    Picks the dispatch backend named in the [dispatch] section of the config,
+    and sets up the spool directories from [spool].
+    """
+    global dispatcher, spool
+    spool = SpoolWriter(
+        spool_dir=config.get('spool', 'spool_dir', fallback='/var/spool/asterisk/outgoing'),
+        staging_dir=config.get('spool', 'staging_dir', fallback='/var/spool/asterisk/staging'))
+    kind = config.get('dispatch', 'backend', fallback='callfile')
+    if kind == 'originate':
+        dispatcher = OriginateDispatcher()
+    elif kind != 'callfile':
+        logging.warning("Unknown dispatch backend %s in config. Using callfile.", kind)
+    logging.info('Dispatching calls with %s', dispatcher.name)
+
 
 # +-----------------------------------------------+
 # |                                               |
@@ -323,69 +1566,287 @@ class Switch():
 # |                                               |
 # +-----------------------------------------------+
 
-def on_DialBegin(event, **kwargs):
+# A decoded AMI event. Only the fields panel_gen actually uses.
+#
+# name:     Event name, e.g. "DialBegin"
+# token:    Account code. This is the magictoken we gave Asterisk.
+# chan:     DAHDI channel number as a string, or '-' if the event
+#           wasn't about a DAHDI channel.
+CallEvent = namedtuple('CallEvent', ['name', 'token', 'chan'])
+
+
+def decode_event(event):
     """
-    Callback function for DialBegin AMI events.
+    Reads the fields we need straight out of an AMI event's key/value
+    mapping. Returns a CallEvent.
 
-    Account Code is a magic number we send to Asterisk and expect
-    to get back. This is how we match events with calls in progress.
+    Dial events put the called side in Dest* fields. Hangup events only
+    have the plain fields. Either way, the DAHDI channel looks like
+    "DAHDI/12-1" and we just want the "12".
+    """
+    keys = event.keys
+    token = keys.get('DestAccountCode') or keys.get('AccountCode', '')
+    channel = keys.get('DestChannel') or keys.get('Channel', '')
+    chan = '-'
+    if channel.startswith('DAHDI/'):
+        chan = channel[6:].partition('-')[0]
+    return CallEvent(event.name, token, chan)
+
+
+def on_ami_event(event, **kwargs):
+    """
+    The one and only AMI event listener. Decodes the event and drops
+    it in the inbox. The engine applies it to lines, in a batch with
+    whatever else came in around the same time.
     """
     try:
-        event = str(event)
+        if event.name not in ami_dispatch:
+            return
+        inbox.put(decode_event(event))
+    except Exception as e:
+        logging.exception(e)
+
+
+# Held by whoever is changing lines and switches: the engine while it
+# ticks or applies AMI events, the timer thread while it runs
+# callbacks, and the API and UI while they start, stop, add or drop
+# lines. LineRegistry.lock only covers the registry's indexes, not
+# the switch counters, so this is the one that counts.
+state_lock = threading.RLock()
+
+
+class EventInbox():
+    """
+    Where decoded AMI events wait to be applied. The AMI listener
+    only adds to it, then gets out of the way. The engine takes
+    everything waiting in one go and applies it under state_lock, so
+    a burst like a Force Stop's few hundred Hangups costs one trip
+    through the lock instead of one each.
+
+    Repeats of the same event for the same call in a batch are dropped.
+    Asterisk sends a Hangup for each leg of a call, and both carry our
+    accountcode.
+
+    queue:          deque of (arrival time, CallEvent). append() and
+                    popleft() on a deque are atomic, so adding to it
+                    takes no lock.
+    armed:          True once somebody's been told to come drain it.
+    """
+
+    def __init__(self):
+        self.queue = deque()
+        self.armed = False
+        self.batches = 0
+        self.events = 0
+        self.coalesced = 0
+        self.batch_max = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def put(self, event):
+        self.queue.append((scheduler.now(), event))
+        if not self.armed:
+            self.armed = True
+            scheduler.wake()
+
+    def drain(self):
+        """ Applies every waiting event. Returns how many there were. """
+        self.armed = False
+        batch = []
+        try:
+            while True:
+                batch.append(self.queue.popleft())
+        except IndexError:
+            pass
+        if batch == []:
+            return 0
+
+        if recorder is not None:
+            recorder.write(batch)
+        with state_lock:
+            self.apply([event for arrived, event in batch])
+
+        now = scheduler.now()
+        self.batches += 1
+        self.events += len(batch)
+        self.batch_max = max(self.batch_max, len(batch))
+        for arrived, event in batch:
+            self.latency_total += now - arrived
+            self.latency_max = max(self.latency_max, now - arrived)
+        return len(batch)
+
+    def apply(self, events, timings=None):
+        """
+        Runs the handler for each event in a batch, skipping repeats.
+        Caller holds state_lock.
+
+        timings:    If given, a list that gets (event name, seconds) for
+                    every handler run. Only replay() wants this.
+        """
+        seen = set()
+        for event in events:
+            if event.token != '':
+                key = (event.name, event.token)
+                if key in seen:
+                    self.coalesced += 1
+                    continue
+                seen.add(key)
+            try:
+                if timings is None:
+                    ami_dispatch[event.name](event)
+                else:
+                    started = perf_counter()
+                    ami_dispatch[event.name](event)
+                    timings.append((event.name, perf_counter() - started))
+            except Exception as e:
+                logging.exception(e)
 
-        DB_DestChannel = re.compile('(?<=DestChannel\'\:\s.{7})([^-]*)')
-        AccountCode = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        return dict([
+            ('queued', len(self.queue)),
+            ('batches', self.batches),
+            ('events', self.events),
+            ('coalesced', self.coalesced),
+            ('batch_avg', self.events / self.batches if self.batches else 0.0),
+            ('batch_max', self.batch_max),
+            ('latency_avg', self.latency_total / self.events if self.events else 0.0),
+            ('latency_max', self.latency_max),
+            ])
 
-        DB_DestChannel = DB_DestChannel.findall(event)
-        AccountCode = AccountCode.findall(event)
 
-        if DB_DestChannel == [] or AccountCode == []:
+inbox = EventInbox()
+
+
+class EventRecorder():
+    """
+    Writes down every AMI event the engine applies, so the traffic can
+    be replayed later with -replay. The file is gzipped text, one event
+    per line:
+
+        seconds batch name token chan switch
+
+    seconds:    When the event arrived, counting from the start of the
+                recording.
+    batch:      Which drain() it was applied in. Events in the same
+                batch get replayed together, repeats and all.
+    switch:     Kind of the line the event was for, or - if it wasn't
+                one of ours.
+
+    path:       File to write. Goes through strftime first, so it can
+                have the date in it.
+    """
+
+    def __init__(self, path):
+        self.path = datetime.now().strftime(path)
+        self.file = gzip.open(self.path, 'wt')
+        self.started = scheduler.now()
+        self.batches = itertools.count()
+        self.events = 0
+        logging.info('Recording AMI events to %s', self.path)
+
+    def write(self, batch):
+        n = next(self.batches)
+        for arrived, event in batch:
+            l = lines.by_magictoken(event.token)
+            self.file.write('{:.3f} {} {} {} {} {}\n'.format(
+                arrived - self.started, n, event.name, event.token or '-',
+                event.chan, l.kind if l is not None else '-'))
+        self.events += len(batch)
+
+    def close(self):
+        self.file.close()
+        logging.info('Recorded %s AMI events to %s', self.events, self.path)
+
+
+# Set by make_recorder() if we're recording.
+recorder = None
+
+
+def make_recorder():
+    """
+    Starts recording AMI events, if -record or "file" under [recorder]
+    in panel_gen.conf says to.
+    """
+    global recorder
+    path = args.record or config.get('recorder', 'file', fallback='')
+    if path:
+        recorder = EventRecorder(path)
+
+
+def read_recording(path):
+    """
+    Reads a file from EventRecorder. Returns a list of batches, each a
+    list of (seconds, CallEvent, switch kind).
+    """
+    batches = []
+    last = None
+    with gzip.open(path, 'rt') as f:
+        for row in f:
+            t, n, name, token, chan, kind = row.split()
+            if n != last:
+                batches.append([])
+                last = n
+            batches[-1].append((float(t), CallEvent(name, '' if token == '-' else token, chan),
+                                kind))
+    return batches
+
+
+def on_DialBegin(event, **kwargs):
+    """
+    Handler for decoded DialBegin AMI events.
+
+    Account Code is a magic number we send to Asterisk and expect
+    to get back. This is how we match events with calls in progress.
+    """
+    try:
+        if event.chan == '-' or event.token == '':
             # Fuckin bail out!
-            logging.debug("***DialBegin regex isn't matching!***")
+            logging.debug("***DialBegin missing DestChannel or AccountCode!***")
             return
 
-        for l in lines:
-            if AccountCode[0] == l.magictoken:
-                l.chan = DB_DestChannel[0]
-                l.ast_status = 'Dialing'
-                l.switch.is_dialing += 1
-                l.switch.on_call +=1
-                l.status = 1
-                l.pending_call = False
-                l.pending_dialend = True
-                l.ami_tmr = 18
-                logging.debug('DialBegin %s on DAHDI/%s from %s ident %s ->>',
-                             l.term, l.chan, l.switch.kind, l.ident)
+        l = lines.by_magictoken(event.token)
+        if l is not None:
+            if l.pending_call and l.dispatched_at is not None:
+                latency = scheduler.now() - l.dispatched_at
+                dispatcher.confirmed(latency)
+                l.switch.dialed += 1
+                l.switch.dial_latency += latency
+            if event.chan != l.reserved_chan:
+                logging.warning('DialBegin on DAHDI/%s but line %s reserved DAHDI/%s',
+                                event.chan, l.ident, l.reserved_chan)
+            l.chan = event.chan
+            l.ast_status = 'Dialing'
+            l.switch.is_dialing += 1
+            l.switch.on_call +=1
+            l.status = 1
+            l.pending_call = False
+            l.pending_dialend = True
+            l.ami_tmr = 18
+            logging.debug('DialBegin %s on DAHDI/%s from %s ident %s ->>',
+                         l.term, l.chan, l.switch.kind, l.ident)
     except Exception as e:
         logging.exception(e)
 
 
 def on_DialEnd(event, **kwargs):
     """
-    Callback function for DialEnd AMI events.
+    Handler for decoded DialEnd AMI events.
 
     """
 
     try:
-        event = str(event)
-
-        DE_DestChannel = re.compile('(?<=DestChannel\'\:\s.{7})([^-]*)')
-        AccountCode = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
-
-        DE_DestChannel = DE_DestChannel.findall(event)
-        AccountCode = AccountCode.findall(event)
-
-        if DE_DestChannel == [] or AccountCode == []:
+        if event.chan == '-' or event.token == '':
             #Outta here
-            logging.debug("***DialEnd regex isn't matching!***")
+            logging.debug("***DialEnd missing DestChannel or AccountCode!***")
             return
 
-        for l in lines:
-            if AccountCode[0] == l.magictoken:
-                logging.debug('FROM ASTERISK: DialEnd for line %s', l.term)
-                l.pending_dialend = False
-                line = l
-                break
+        line = lines.by_magictoken(event.token)
+        if line is not None:
+            logging.debug('FROM ASTERISK: DialEnd for line %s', line.term)
+            if line.pending_dialend:
+                line.switch.completed += 1
+            line.pending_dialend = False
 
         def doDialEnd():
             try:
@@ -395,6 +1856,7 @@ def on_DialEnd(event, **kwargs):
                     if line.ast_status == 'Dialing':
                         line.ast_status = 'Ringing'
                         line.switch.is_dialing -= 1
+                        line.switch.admit()
                         logging.debug('Ringing %s on line %s', line.term, line.ident)
                     elif line.ast_status == 'on_hook':
                         logging.error('How did we get to DialEnd from on_hook?')
@@ -408,58 +1870,72 @@ def on_DialEnd(event, **kwargs):
                 logging.exception(e)
 
         if len(lines) > 0:
-            if line:
-                enqueue_event(line.switching_delay, doDialEnd)
+            if line is not None:
+                enqueue_event(line.switching_delay, doDialEnd, owner=line)
                 logging.debug("B: Event enqueued  delay %s.", line.switching_delay)
 
     except Exception as e:
         logging.exception(e)
 
-def enqueue_event(delay, callback):
+def enqueue_event(delay, callback, owner=None):
+    """
+    Runs callback after delay seconds on the timer thread.
+    Returns a TimerHandle that can be cancelled.
+
+    owner:      Line the callback belongs to. When the line is destroyed,
+                its pending callbacks are cancelled with it.
+    """
     try:
-        eventtimer = threading.Timer(delay, callback)
-        eventtimer.start()
+        handle = t_timer.call_later(delay, callback, owner)
         logging.debug("A: Started event timer delay %s", delay)
+        return handle
     except Exception as e:
         logging.exception(e)
 
 
 def on_Hangup(event, **kwargs):
     """
-    Callback for processing hangup events.
+    Handler for decoded Hangup events.
     """
 
     try:
-        event = str(event)
-        HU_DestChannel = re.compile('(?<=DestChannel\'\:\s.{7})([^-]*)')
-        AccountCode = re.compile('[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
-
-        AccountCode = AccountCode.findall(event)
-        HU_DestChannel = HU_DestChannel.findall(event)
-
-        if AccountCode == []:
-            logging.debug("*** AccountCode didn't match on hangup***")
+        if event.token == '':
+            logging.debug("*** No AccountCode on hangup***")
             return
 
-        for l in lines:
-            if AccountCode[0] == l.magictoken:
-                if l.ast_status == 'Dialing':
-                    l.switch.is_dialing -= 1
-                    logging.debug('Hangup while dialing %s on DAHDI %s', l.term, l.chan)
-
-                l.status = 0
-                l.chan = '-'
-                l.ast_status = 'on_hook'
-                l.switch.on_call -= 1
-                l.timer = l.switch.newtimer()
-                l.term = l.pick_next_called(term_choices)
-                l.pending_hangup = False
-                logging.debug('<<- Asterisk reports hangup OK. Line %s status is %s',
-                              l.ident, l.status)
+        l = lines.by_magictoken(event.token)
+        if l is not None:
+            if l.ast_status == 'Dialing':
+                l.switch.is_dialing -= 1
+                logging.debug('Hangup while dialing %s on DAHDI %s', l.term, l.chan)
+
+            l.status = 0
+            l.chan = '-'
+            l.switch.freechannel(l)
+            l.ast_status = 'on_hook'
+            l.switch.on_call -= 1
+            # Same as Line.hangup(). Asterisk may have hung up first, and
+            # ld_calls has to come down either way.
+            l.longdistance = False
+            l.switching_delay = 0
+            l.timer = l.switch.newtimer()
+            l.term = l.pick_next_called(term_choices)
+            l.pending_hangup = False
+            l.switch.admit()
+            logging.debug('<<- Asterisk reports hangup OK. Line %s status is %s',
+                          l.ident, l.status)
     except Exception as e:
         logging.exception(e)
 
 
+# Which handler gets which AMI event. Anything not in here is ignored.
+ami_dispatch = {
+    'DialBegin':    on_DialBegin,
+    'DialEnd':      on_DialEnd,
+    'Hangup':       on_Hangup,
+    }
+
+
 def parse_args():
     # Gets called at runtime and parses arguments given on command line.
     # If no arguments are presented, the program will run with default
@@ -482,6 +1958,35 @@ def parse_args():
             'normal, or heavy. Default is normal, which is good for average load.')
     parser.add_argument('-log', metavar='loglevel', type=str, default='INFO',
             help='Set log level to WARNING, INFO, DEBUG.')
+    parser.add_argument('-sim', metavar='hours', type=float, default=None,
+            help='Don\'t touch Asterisk. Simulate this many hours of traffic as fast as '
+            'possible, then print calls, sender occupancy and blocking for each switch.')
+    parser.add_argument('-simlines', metavar='n,n,...', type=str, default=None,
+            help='With -sim, run once for each of these numbers of lines per switch, '
+            'instead of lines_normal or lines_heavy from the config.')
+    parser.add_argument('-bench', metavar='file', type=str, default=None,
+            help='Don\'t touch Asterisk. Time the busiest parts of panel_gen with more '
+            'and more lines, and write the results to file as JSON. - for stdout.')
+    parser.add_argument('-benchlines', metavar='n,n,...', type=str, default=None,
+            help='With -bench, the numbers of lines to try. Default is 10,100,1000,10000.')
+    parser.add_argument('-engine', metavar='scheduler', type=str, default=None,
+            choices=['heap','array'],
+            help='With -sim, -bench or -replay, which scheduler to run on: heap or array. '
+            'Default is scheduler under [engine] in the config.')
+    parser.add_argument('-stress', metavar='switch', type=str, default=None,
+            choices=['1xb','5xb','panel'],
+            help='Add lines to a switch a few at a time until calls per minute stop going '
+            'up, then print where that happened. Settings are under [stress] in the config. '
+            'Works with -sim too.')
+    parser.add_argument('-record', metavar='file', type=str, default=None,
+            help='Record every AMI event to file, for -replay later. Can have strftime '
+            'codes in it, like ami-%%Y%%m%%d.gz.')
+    parser.add_argument('-replay', metavar='file', type=str, default=None,
+            help='Don\'t touch Asterisk. Play a recording from -record back through the '
+            'event handlers, and report how fast they went.')
+    parser.add_argument('-speed', metavar='speed', type=str, default='max',
+            help='With -replay, how many times faster than real time to go, or max. '
+            'Default is max.')
 
     global args
     args = parser.parse_args()
@@ -512,7 +2017,7 @@ def longdistance(line, chan):
                         line.longdistance = True
 
     if line.kind == "5xb":
-        too_many = sum(1 for l in lines if l.longdistance == True and l.kind =="5xb")
+        too_many = line.switch.ld_calls
         if line.term[0:3] == "832" or line.term[0:3] == "232":
             i=random.randint(0,10)
             if i >= 5:
@@ -528,22 +2033,16 @@ def longdistance(line, chan):
 
 def safetynet():
     # Most of these things should never need to be done
-    # but its better to be fault tolerant if possible
+    # but its better to be fault tolerant if possible.
+    # This only looks at each switch's counters, so it's cheap enough
+    # to run every time the work thread wakes up. Lines check their
+    # own AMI timeouts in Line.check_pending().
 
     def doRestartSwitch(reason, kind):
         api_stop(switch=s.kind)
         api_start(switch=s.kind)
         logging.error("Restarted switch %s due to invalid state: %s", kind, reason)
 
-    def errorhandle(reason, status):
-
-        logging.error("Failed to get AMI %s within allotted time on %s",
-                      status, l)
-        logging.error("Channel: %s", l.chan)
-        logging.error("Status: %s", l.status)
-        logging.error("Asterisk: %s", l.ast_status)
-        logging.error("Term: %s", l.human_term)
-
     reason = ''
 
     for s in originating_switches:
@@ -555,30 +2054,14 @@ def safetynet():
             reason = "exceeded max dialing"
             doRestartSwitch(reason, s.kind)
 
-    for l in lines:
-        if l.pending_call == True:
-            status = "DialBegin"
-            if l.ami_tmr <= 0:
-                l.pending_call = False
-                errorhandle(reason, status)
-
-        if l.pending_dialend == True:
-            status = "DialEnd"
-            if l.ami_tmr <= 0:
-                l.pending_dialend = False
-                errorhandle(reason, status)
-
-        if l.pending_hangup == True:
-            status = "Hangup"
-            if l.ami_tmr <= 0:
-                l.pending_hangup = False
-                # This pass prevents silly threading confusion where
-                # asterisk will report a hangup before we realize that we've
-                # asked for one ;P
-                if l.chan == '-':
-                    pass
-                else:
-                    errorhandle(reason, status)
+        # In case anything freed up a sender without telling us.
+        s.admit()
+
+        if s.on_call < 0 or s.ld_calls < 0 or s.pending < 0:
+            logging.error("Counters on %s went negative. on_call: %s, " +
+                          "long distance: %s, pending: %s. Recounting.",
+                          s.kind, s.on_call, s.ld_calls, s.pending)
+            s.recount()
 
 
 def make_switch(args):
@@ -656,12 +2139,14 @@ def make_lines(**kwargs):
         new_lines = []
         if source == 'main':
             if args.a == []:
-                new_lines = [Line(n, switch) for switch in originating_switches for n in range(switch.lines_normal)]
+                new_lines = [lines.new(switch) for switch in originating_switches
+                             for n in range(switch.lines_normal)]
             else:
-                new_lines = [Line(n, switch) for switch in originating_switches for n in range(args.a)]
+                new_lines = [lines.new(switch) for switch in originating_switches
+                             for n in range(args.a)]
 
         elif source == 'api':
-            new_lines = [Line(n, switch) for n in range(numlines)]
+            new_lines = [lines.new(switch) for n in range(numlines)]
     except Exception as e:
         logging.exception(e)
 
@@ -685,19 +2170,440 @@ def start_ui():
         print(e)
 
 def ami_connect(AMI_ADDRESS, AMI_PORT, AMI_USER, AMI_SECRET):
-    global client
+    """
+    Starts the AMI manager. If Asterisk isn't up yet, that's OK. The
+    manager keeps trying in the background.
+    """
+    global t_ami
     global adapter
-    client = AMIClient(address=AMI_ADDRESS, port=int(AMI_PORT))
-    adapter = AMIClientAdapter(client)
-    future = client.login(username=AMI_USER, secret=AMI_SECRET)
-    logging.info('Connected to Asterisk AMI')
-    if future.response.is_error():
-        raise Exception(str(future.response))
+    if scheduler.name == 'asyncio':
+        # The asyncio engine connects once its loop is running.
+        # See start_engine().
+        from aio_engine import aio_ami, LoopAMIAdapter
+        t_ami = aio_ami(AMI_ADDRESS, AMI_PORT, AMI_USER, AMI_SECRET)
+        adapter = LoopAMIAdapter(t_ami)
+        return
+
+    t_ami = ami_manager(AMI_ADDRESS, AMI_PORT, AMI_USER, AMI_SECRET)
+    try:
+        t_ami.connect()
+    except Exception as e:
+        t_ami.last_error = str(e)
+        logging.error('AMI connection failed. Will keep trying. %s', e)
+    t_ami.daemon = True
+    t_ami.start()
+
+
+class ami_manager(threading.Thread):
+    # Looks after our two AMI connections. One only listens for events,
+    # the other only sends actions, so a burst of events can't hold up
+    # a Hangup, and a pile of Hangups can't hold up events.
+    #
+    # Pings both every second or so. (python-ami also drops a connection
+    # that's quiet for 3 seconds, so this keeps them awake.) If either one
+    # stops answering, tear them both down and log back in, waiting a bit
+    # longer after each failed try. After a reconnect, check our lines
+    # against the calls Asterisk actually has.
+
+    def __init__(self, address, port, user, secret, interval=1, backoff_max=30):
+
+        threading.Thread.__init__(self, name='ami_manager')
+        self.shutdown_flag = threading.Event()
+        self.address = address
+        self.port = int(port)
+        self.user = user
+        self.secret = secret
+        self.interval = interval
+        self.backoff_max = backoff_max
+        self.events = None
+        self.actions = None
+        self.connected = False
+        self.reconnects = 0
+        self.resyncs = 0
+        self.last_error = ''
+
+    def login(self):
+        c = AMIClient(address=self.address, port=self.port)
+        response = c.login(username=self.user, secret=self.secret).response
+        if response is None or response.is_error():
+            c.disconnect()
+            raise Exception('AMI login failed: {}'.format(response))
+        return c
+
+    def connect(self):
+        global client
+        global adapter
+
+        events = self.login()
+        try:
+            # Ask Asterisk to only send us the events we care about.
+            ami_filter(AMIClientAdapter(events))
+
+            # This listener is for the AMI so I can catch events. It hands
+            # them out to the handlers in ami_dispatch. It still only lets
+            # through events in ami_dispatch, in case the filters didn't take.
+            events.add_event_listener(on_ami_event, white_list = list(ami_dispatch))
+
+            actions = self.login()
+        except Exception:
+            events.disconnect()
+            raise
+
+        # No events at all on the action connection. Replies to things
+        # like CoreShowChannels still come through.
+        AMIClientAdapter(actions).Events(EventMask='off')
+
+        with ami_lock:
+            self.events = events
+            self.actions = actions
+            client = actions
+            adapter = AMIClientAdapter(actions)
+        self.connected = True
+        logging.info('Connected to Asterisk AMI')
+
+    def alive(self):
+        """ Pings both connections. False if either one is dead. """
+        try:
+            for c in (self.events, self.actions):
+                if c is None or c.finished is None or c.finished.is_set():
+                    self.last_error = 'connection closed'
+                    return False
+            sent = scheduler.now()
+            responses = [ami_action('Ping').response]
+            if responses[0] is not None:
+                ami_latency['ping'].record(scheduler.now() - sent)
+            responses.append(AMIClientAdapter(self.events).Ping().response)
+        except Exception as e:
+            self.last_error = str(e)
+            return False
+        for r in responses:
+            if r is None or r.is_error():
+                self.last_error = 'no answer to Ping'
+                return False
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        for c in (self.events, self.actions):
+            if c is not None:
+                try:
+                    c.disconnect()
+                except Exception:
+                    pass
+        self.events = None
+        self.actions = None
+
+    def logoff(self):
+        self.shutdown_flag.set()
+        for c in (self.events, self.actions):
+            if c is not None:
+                try:
+                    c.logoff()
+                except Exception:
+                    pass
+
+    def resync(self):
+        """
+        Asks Asterisk what channels are up, and squares lines with it.
+        A line that thinks it has a call Asterisk doesn't know about gets
+        hung up on our end. A call with one of our tokens that no line
+        owns gets hung up on Asterisk's end.
+        """
+        live = {}
+        done = threading.Event()
+
+        def listed(event, **kwargs):
+            if event.keys.get('ActionID') != action_id:
+                return
+            if event.name == 'CoreShowChannelsComplete':
+                done.set()
+                return
+            e = decode_event(event)
+            if e.token != '':
+                live[e.token] = e.chan
+
+        self.resyncs += 1
+        action_id = 'resync-{}'.format(self.resyncs)
+        listener = self.actions.add_event_listener(listed,
+                white_list=['CoreShowChannel', 'CoreShowChannelsComplete'])
+        try:
+            response = ami_action('CoreShowChannels', ActionID=action_id).response
+            if response is None or response.is_error():
+                logging.warning('CoreShowChannels failed: %s', response)
+                return
+            if not done.wait(5):
+                logging.warning('CoreShowChannels never finished. Skipping resync.')
+                return
+        finally:
+            self.actions.remove_event_listener(listener)
+
+        with state_lock:
+            orphans = reconcile_lines(live)
+        if orphans:
+            hangup_channels(orphans)
+
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        return dict([
+            ('connected', self.connected),
+            ('reconnects', self.reconnects),
+            ('resyncs', self.resyncs),
+            ('last_error', self.last_error),
+            ])
+
+    def run(self):
+        delay = 1
+        while not self.shutdown_flag.is_set():
+            if self.connected:
+                if self.alive():
+                    self.shutdown_flag.wait(self.interval)
+                    continue
+                logging.warning('Lost AMI connection: %s', self.last_error)
+                self.disconnect()
+
+            try:
+                self.connect()
+            except Exception as e:
+                self.last_error = str(e)
+                logging.warning('AMI reconnect failed. Trying again in %ss. %s', delay, e)
+                self.shutdown_flag.wait(delay)
+                delay = min(delay * 2, self.backoff_max)
+                continue
+
+            delay = 1
+            self.reconnects += 1
+            try:
+                self.resync()
+            except Exception as e:
+                logging.exception(e)
+
+
+def reconcile_lines(live):
+    """
+    Squares lines with what Asterisk says is up. Lines that think they
+    have a call that isn't in live get reset through on_Hangup().
+
+    live:       Dict of accountcode -> channel, from CoreShowChannels.
+
+    Returns the channels of calls with one of our tokens that no line
+    owns, so the caller can hang them up.
+    """
+    gone = 0
+    for l in list(lines):
+        if l.chan != '-' and l.magictoken not in live:
+            on_Hangup(CallEvent('Hangup', l.magictoken, l.chan))
+            gone += 1
+
+    orphans = [chan for token, chan in live.items()
+               if lines.by_magictoken(token) is None and is_magictoken(token)]
+    logging.info('AMI resync: %s calls up, %s lines reset, %s orphans',
+                 len(live), gone, len(orphans))
+    return orphans
+
+def is_magictoken(token):
+    """ True if token looks like something Line.call() made. """
+    try:
+        return str(uuid.UUID(token)) == token
+    except ValueError:
+        return False
+
+# Only events from ami_dispatch, and only if they have an accountcode
+# that looks like one of our magic tokens. Asterisk doesn't use
+# REG_NEWLINE, so .* runs across the header lines of the event.
+# (No CR LF in the pattern. It would end the Filter: header early.)
+AMI_FILTER = 'Event: ({}).*AccountCode: [0-9a-f]{{8}}-'
+
+def ami_filter_steps():
+    """ The AMI actions that set up server side filtering, in order. """
+    return [('Events', dict(EventMask='call')),
+            ('Filter', dict(Operation='Add',
+                            Filter=AMI_FILTER.format('|'.join(ami_dispatch))))]
+
+def ami_filter(events):
+    """
+    Tells Asterisk to stop sending us everything that happens on the
+    box. First cut it down to the call event class, then add a filter
+    so only DialBegin, DialEnd and Hangup for our own calls get through.
+
+    events:     AMIClientAdapter for the event connection.
+
+    If Asterisk says no (old version, or the AMI user lacks permission),
+    we just get every event and throw most of them away like before.
+    Returns True if the filters went in.
+    """
+    ok = True
+    for name, keys in ami_filter_steps():
+        try:
+            response = getattr(events, name)(**keys).response
+        except Exception as e:
+            response = None
+            logging.warning('AMI %s failed: %s', name, e)
+        if response is None or response.is_error():
+            logging.warning('AMI %s not accepted: %s', name, response)
+            ok = False
+            break
+    if ok:
+        logging.info('AMI server side event filter installed')
+    else:
+        logging.warning('Filtering AMI events on our end instead.')
+    return ok
+
+def ping_text():
+    """ Last AMI ping time for the status bar, or 'down'. """
+    last = ami_latency['ping'].last
+    if not t_ami.connected or last is None:
+        return 'down'
+    return '{}ms'.format(int(round(last)))
+
+
+class LatencyHistogram():
+    """
+    Counts round trip times into buckets, so we can see how the AMI
+    link is doing over time and not just right now.
+
+    bounds:     Upper edge of each bucket, in milliseconds. Anything
+                slower than the last one goes in an extra bucket on the end.
+    counts:     How many samples landed in each bucket.
+    last:       Most recent sample, in milliseconds.
+    """
+
+    bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = None
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        i = 0
+        while i < len(self.bounds) and ms > self.bounds[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.total += 1
+            self.sum += ms
+            self.max = max(self.max, ms)
+            self.last = ms
+
+    def percentile(self, p):
+        # Upper edge of the bucket the p'th percentile falls in.
+        want = self.total * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= want:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def stats(self):
+        """ Returns a dict for the API. Times are in milliseconds. """
+        with self.lock:
+            labels = ['<={}'.format(b) for b in self.bounds] + ['>{}'.format(self.bounds[-1])]
+            return dict([
+                ('count', self.total),
+                ('last', self.last),
+                ('avg', self.sum / self.total if self.total else 0.0),
+                ('max', self.max),
+                ('p50', self.percentile(50)),
+                ('p99', self.percentile(99)),
+                ('buckets', dict(zip(labels, self.counts))),
+                ])
+
+
+# Ping is the heartbeat from the AMI manager. Hangup and originate
+# are how long Asterisk takes to answer those actions.
+ami_latency = {
+    'ping':         LatencyHistogram(),
+    'hangup':       LatencyHistogram(),
+    'originate':    LatencyHistogram(),
+    }
+
+def timed_action(kind, name, **kwargs):
+    """
+    Sends an AMI action like ami_action(), and records how long Asterisk
+    takes to answer it in ami_latency[kind].
+    """
+    sent = scheduler.now()
+    def answered(response):
+        ami_latency[kind].record(scheduler.now() - sent)
+    return ami_action(name, _callback=answered, **kwargs)
 
-    # These listeners are for the AMI so I can catch events.
-    client.add_event_listener(on_DialBegin, white_list = 'DialBegin')
-    client.add_event_listener(on_DialEnd, white_list = 'DialEnd')
-    client.add_event_listener(on_Hangup, white_list = 'Hangup')
+ami_lock = threading.Lock()
+
+def ami_action(name, **kwargs):
+    """
+    Sends an AMI action and returns its future. python-ami doesn't
+    lock around action ids or socket writes, so the I/O pool and the
+    API threads take turns here.
+    """
+    with ami_lock:
+        return getattr(adapter, name)(**kwargs)
+
+def hangup_channels(chans, timeout=2.0):
+    """
+    Hangs up a whole bunch of DAHDI channels at once. Every Hangup
+    action goes out back to back, and nobody sits around waiting for
+    the answers. They're tallied as they come in, and timeout seconds
+    later a timer logs whoever never answered. So stopping a few
+    hundred lines costs one burst of writes, and never holds up the
+    work thread or the asyncio loop (which is where the answers show
+    up on that engine).
+
+    chans:      Channel numbers, like '12'.
+    timeout:    Seconds to give Asterisk before we call it unconfirmed.
+
+    Returns a dict that fills in as responses arrive:
+        confirmed:      Asterisk said Success.
+        errors:         Asterisk said Error. (Usually already gone.)
+        unconfirmed:    Never heard back by deadline, or the send
+                        itself failed.
+        deadline:       When we stop listening.
+    """
+    result = {'confirmed': [], 'errors': [], 'unconfirmed': []}
+    waiting = set()
+    lock = threading.Lock()
+
+    def answered(chan, response):
+        ami_latency['hangup'].record(scheduler.now() - sent)
+        with lock:
+            if chan not in waiting:
+                return
+            waiting.discard(chan)
+            if response.is_error():
+                result['errors'].append(chan)
+            else:
+                result['confirmed'].append(chan)
+
+    def overdue():
+        with lock:
+            late = sorted(waiting)
+            result['unconfirmed'].extend(late)
+            waiting.clear()
+        if late:
+            logging.warning('No hangup response for channels %s', late)
+
+    sent = scheduler.now()
+    result['deadline'] = sent + timeout
+    with ami_lock:
+        for chan in set(chans):
+            with lock:
+                waiting.add(chan)
+            try:
+                adapter.Hangup(Channel='DAHDI/{}-1'.format(chan),
+                               _callback=partial(answered, chan))
+            except Exception as e:
+                logging.warning('Hangup on DAHDI/%s failed to send: %s', chan, e)
+                with lock:
+                    waiting.discard(chan)
+                    result['unconfirmed'].append(chan)
+
+    if waiting:
+        enqueue_event(timeout, overdue)
+    return result
 
 
 # +----------------------------------------------------+
@@ -781,6 +2687,23 @@ def get_info():
     return schema.dump(result)
 
 
+def get_stats():
+    """ Returns internal performance counters. """
+
+    result = dict([
+        ('timers', t_timer.stats()),
+        ('ami', t_ami.stats()),
+        ('latency', dict((k, h.stats()) for k, h in ami_latency.items())),
+        ('events', inbox.stats()),
+        ('dispatch', dispatcher.stats()),
+        ('io', t_io.stats()),
+        ('spool', spool.stats()),
+        ('backpressure', pressure.stats()),
+        ('switches', dict((s.kind, s.counters()) for s in originating_switches)),
+        ])
+    return result
+
+
 def api_start(**kwargs):
     """
     Creates new lines when started from API.
@@ -797,7 +2720,6 @@ def api_start(**kwargs):
 
     """
 
-    global lines
     global new_lines
     source = kwargs.get('source', '')
     switch = kwargs.get('switch', '')
@@ -812,72 +2734,121 @@ def api_start(**kwargs):
             logging.warning('I dont know why, but we are starting on %s', switch)
 
         if t_work.is_alive == True:
-            for i in originating_switches:
-                if switch == i.kind:
-                    if i.running == True:
-                        logging.warning("%s is running. Can't start twice.", i.kind)
-                    elif i.running == False:
-
-                        # Reset the dialing counter for safety.
-                        i.is_dialing = 0
-
-                        # This block handles whether or not the user passed in
-                        # a traffic load setting. If not, we'll just use whatever
-                        # we already have.
-                        if traffic_load == "normal" or traffic_load == "heavy":
-                            if traffic_load != i.traffic_load:
-                                i.traffic_load = traffic_load
-                                logging.info('Changing traffic load to %s', traffic_load)
-                        if i.traffic_load == 'heavy':
-                            numlines = i.lines_heavy
-                        if i.traffic_load == 'normal':
-                            numlines = i.lines_normal
-                        if i == Adams:
-                            # Carve out a special case for Sundays. This was requested
-                            # by museum volunteers so that we can give tours of the
-                            # step and 1XB without interruption by the this program.
-                            # This will only be effective if the key is operated.
-                            # Will have no impact when using web app.
-                            if datetime.today().weekday() == 6:
-                                logging.info('Its Sunday!')
-                                if source == 'key':
-                                    logging.info('5XB special Sunday mode active')
-                                    i.trunk_load = [.1, .80, .1, .0, .0, .0, .0, .0]
-                                    new_lines = make_lines(switch=i, numlines=numlines,
-                                    source='api')
-
-                                # Adams: If we start from the web interface, ignore
-                                # those rules.
+            with state_lock:
+                for i in originating_switches:
+                    if switch == i.kind:
+                        if i.running == True:
+                            logging.warning("%s is running. Can't start twice.", i.kind)
+                        elif i.running == False:
+
+                            # Reset the dialing counter for safety.
+                            i.is_dialing = 0
+
+                            # This block handles whether or not the user passed in
+                            # a traffic load setting. If not, we'll just use whatever
+                            # we already have.
+                            if traffic_load == "normal" or traffic_load == "heavy":
+                                if traffic_load != i.traffic_load:
+                                    i.traffic_load = traffic_load
+                                    logging.info('Changing traffic load to %s', traffic_load)
+                            if i.traffic_load == 'heavy':
+                                numlines = i.lines_heavy
+                            if i.traffic_load == 'normal':
+                                numlines = i.lines_normal
+                            if i == Adams:
+                                # Carve out a special case for Sundays. This was requested
+                                # by museum volunteers so that we can give tours of the
+                                # step and 1XB without interruption by the this program.
+                                # This will only be effective if the key is operated.
+                                # Will have no impact when using web app.
+                                if datetime.today().weekday() == 6:
+                                    logging.info('Its Sunday!')
+                                    if source == 'key':
+                                        logging.info('5XB special Sunday mode active')
+                                        i.trunk_load = [.1, .80, .1, .0, .0, .0, .0, .0]
+                                        new_lines = make_lines(switch=i, numlines=numlines,
+                                        source='api')
+
+                                    # Adams: If we start from the web interface, ignore
+                                    # those rules.
+                                    else:
+                                        logging.info('5XB special Sunday mode skipped')
+                                        new_lines = make_lines(switch=i, numlines=numlines,
+                                        source='api')
+
+                                # Adams: If its any other day of the week, just act normal.
                                 else:
-                                    logging.info('5XB special Sunday mode skipped')
                                     new_lines = make_lines(switch=i, numlines=numlines,
                                     source='api')
 
-                            # Adams: If its any other day of the week, just act normal.
+                            # Everyone else: Make lines.
                             else:
                                 new_lines = make_lines(switch=i, numlines=numlines,
                                 source='api')
 
-                        # Everyone else: Make lines.
-                        else:
-                            new_lines = make_lines(switch=i, numlines=numlines,
-                            source='api')
-
-                        # Append the lines we just created.
-                        for l in new_lines:
-                            lines.append(l)
+                            # Append the lines we just created.
+                            lines.extend(new_lines)
 
-                        i.running = True
-                        logging.info('Appended %s lines to %s', len(new_lines), switch)
+                            i.running = True
+                            logging.info('Appended %s lines to %s', len(new_lines), switch)
 
-                    lines_created = len(new_lines)
-                    result = get_info()
-                    return result
+                        lines_created = len(new_lines)
+                        result = get_info()
+                        return result
     except Exception as e:
         logging.execption(e)
         return False
 
 
+def api_stress(**kwargs):
+    """
+    Starts a stress test on a switch. See StressTest. Only one can run
+    at a time. Returns the test's results so far, or False.
+
+    switch:     Which switch. Has to be one we originate on.
+    step:       Lines to add each step. Optional, like the rest.
+    interval:   Seconds per step.
+    max_lines:  Most lines to try.
+    """
+    global stress
+    switch = kwargs.get('switch', '')
+
+    if stress is not None and not stress.done:
+        logging.warning("Stress test on %s is still running. Can't start another.",
+                        stress.switch.kind)
+        return False
+
+    for s in originating_switches:
+        if s.kind == switch:
+            logging.info("App requested STRESS on %s", switch)
+            stress = make_stress(s, step=kwargs.get('step'), interval=kwargs.get('interval'),
+                                 max_lines=kwargs.get('max_lines'))
+            with state_lock:
+                stress.start()
+            return stress.results()
+    return False
+
+
+def get_stress():
+    """ Returns the latest stress test's results, or False if there hasn't been one. """
+    if stress is None:
+        return False
+    return stress.results()
+
+
+def busy_channels(these):
+    """
+    Channels that lines in these have a call on, or have a call
+    headed to.
+    """
+    chans = []
+    for l in these:
+        if l.chan != '-':
+            chans.append(l.chan)
+        elif l.pending_call and l.reserved_chan is not None:
+            chans.append(l.reserved_chan)
+    return chans
+
 def api_stop(**kwargs):
     """
     Immediately hang up calls, and destroy lines.
@@ -898,39 +2869,39 @@ def api_stop(**kwargs):
     elif source == 'module':
         logging.info('Module exited. Hanging up.')
 
-    global lines
-
     try:
-        if switch == 'all':
-            for l in lines:
-                l.hangup()
-            lines = []
-            for s in originating_switches:
-                s.running = False
-                s.is_dialing = 0
-                s.on_call = 0
+        with state_lock:
+            if switch == 'all':
+                hangup_channels(busy_channels(lines))
+                lines.clear()
+                for s in originating_switches:
+                    s.running = False
+                    s.is_dialing = 0
+                    s.on_call = 0
+            else:
+                for s in originating_switches:
+                    if s.kind == switch:
+                        deadlines = lines.on_switch(s.kind)
+                        s.running = False
 
+                        hangup_channels(busy_channels(deadlines))
+                        for n in deadlines:
+                            lines.remove(n)
+                        s.is_dialing = 0
+                        s.on_call = 0
+
+        if switch == 'all':
             # Just hangup all channels when I use the FORCE button.
             # After all. If I hit that button, I'm not kidding.
-            adapter.Hangup(Channel='/(.*?)/')
-
-            # Delete all remaining files in spool.
+            # If AMI is down that's no reason to leave the spool full.
             try:
-                system("rm /var/spool/asterisk/outgoing/*.call > /dev/null 2>&1")
+                ami_action('Hangup', Channel='/(.*?)/')
             except Exception as e:
-                logging.warning("Failed to delete remaining files in spool.")
-                logging.warning(e)
-        else:
-            for s in originating_switches:
-                if s.kind == switch:
-                    deadlines = [l for l in lines if l.kind == s.kind]
-                    lines = [l for l in lines if l.kind != s.kind]
-                    s.running = False
-                    s.is_dialing = 0
+                logging.warning("Couldn't send Hangup for every channel: %s", e)
 
-                    for n in deadlines:
-                        n.hangup()
-                    s.on_call = 0
+            # Delete any of our files still in the spool.
+            removed = spool.cleanup()
+            logging.info("Deleted %s leftover .call files from spool.", removed)
 
     except Exception as e:
         logging.exception(e)
@@ -950,21 +2921,16 @@ def get_line(ident):
     # Check if ident passed in via API exists in lines.
     # If so, send back that line. Else, return False..
 
-    api_ident = int(ident)
     schema = LineSchema()
-    result = None
-    for l in lines:
-        if api_ident == l.ident:
-            result = (schema.dump(l))
-    if result == None:
+    l = lines.get(int(ident))
+    if l is None:
         return False
     else:
-        return result
+        return schema.dump(l)
 
 def create_line(**kwargs):
     # Creates a new line using default parameters.
-    # lines.append uses the current number of lines in list
-    # to create the ident value for the new line.
+    # The registry hands out a fresh ident for each new line.
 
     schema = LineSchema()
     result = []
@@ -972,11 +2938,13 @@ def create_line(**kwargs):
     switch = kwargs.get('switch','')
     numlines = kwargs.get('numlines','')
 
-    for i in originating_switches:
-        if switch == i or switch == i.kind:
-            for n in range(numlines):
-                lines.append(Line(len(lines), i))
-                result.append(len(lines) - 1)
+    with state_lock:
+        for i in originating_switches:
+            if switch == i or switch == i.kind:
+                for n in range(numlines):
+                    l = lines.new(i)
+                    lines.add(l)
+                    result.append(l.ident)
 
     if result == []:
         return False
@@ -992,13 +2960,15 @@ def delete_line(**kwargs):
     numlines:   number of lines to delete
     """
 
-    global lines
     switch = kwargs.get('switch','')
 
-    for i in originating_switches:
-        if i == switch or i.kind == kwargs.get('kind',''):
-            for n in range(kwargs.get('numlines','')):
-                lines.pop()
+    with state_lock:
+        for i in originating_switches:
+            if i == switch or i.kind == kwargs.get('kind',''):
+                on_switch = lines.on_switch(i.kind)
+                numlines = kwargs.get('numlines', 0)
+                for l in on_switch[max(len(on_switch) - numlines, 0):]:
+                    lines.remove(l)
 
     result = get_switch(i.kind)
 
@@ -1065,28 +3035,29 @@ def update_switch(**kwargs):
     schema = SwitchSchema()
     result = []
 
-    for i in originating_switches:
-        if i.kind == kwargs.get("kind", ""):
-            # Wipe out the top parameter, because I said so
-            del kwargs['kind']
-            # Lets iterate over the parameters we can work with.
-            for k,v in kwargs.items():
-                for k1 in v.items():
-                    desired_load = k1[1]
-                    if i.traffic_load != desired_load:
-                        i.traffic_load = desired_load
-
-                        # Determine how many lines we have to add or remove.
-                        numlines = i.lines_heavy - i.lines_normal
-
-                        if i.running == True:
-                            if i.traffic_load == 'heavy':
-                                create_line(switch=i, numlines=numlines)
-                            elif i.traffic_load == 'normal':
-                                delete_line(switch=i, numlines=numlines)
-                        logging.info("Traffic on %s changed to %s",
-                                    i.kind, i.traffic_load)
-            result.append(schema.dump(i))
+    with state_lock:
+        for i in originating_switches:
+            if i.kind == kwargs.get("kind", ""):
+                # Wipe out the top parameter, because I said so
+                del kwargs['kind']
+                # Lets iterate over the parameters we can work with.
+                for k,v in kwargs.items():
+                    for k1 in v.items():
+                        desired_load = k1[1]
+                        if i.traffic_load != desired_load:
+                            i.traffic_load = desired_load
+
+                            # Determine how many lines we have to add or remove.
+                            numlines = i.lines_heavy - i.lines_normal
+
+                            if i.running == True:
+                                if i.traffic_load == 'heavy':
+                                    create_line(switch=i, numlines=numlines)
+                                elif i.traffic_load == 'normal':
+                                    delete_line(switch=i, numlines=numlines)
+                            logging.info("Traffic on %s changed to %s",
+                                        i.kind, i.traffic_load)
+                result.append(schema.dump(i))
     if result != []:
         return result
     else:
@@ -1102,10 +3073,7 @@ def test_call(num_to_dial, ast_channel):
     logging.info(channel)
     vars = {'waittime':10}
 
-    c = Call(channel, variables=vars, callerid='test')
-    con = Context('sarah_callsim', num_to_dial, '1')
-    cf = CallFile(c, con)
-    cf.spool()
+    dispatcher.originate(channel, num_to_dial, vars, 'test')
 
 
 
@@ -1145,13 +3113,15 @@ class Screen():
         # u: add a line to the first switch.
         if key == ord('u'):
             try:
-                lines.append(Line(7, originating_switches[0]))
+                with state_lock:
+                    lines.add(lines.new(originating_switches[0]))
             except Exception:
                 logging.warning("Couldn't add lines to switch.")
         # d: delete the 0th line.
         if key == ord('d'):
-            if len(lines) >= 1:
-                del lines[0]
+            with state_lock:
+                if len(lines) >= 1:
+                    lines.pop(0)
 
     def update_size(self, stdscr, y, x):
         # This gets called if the screen is resized. Makes it happy so
@@ -1224,6 +3194,9 @@ class Screen():
                 pass
 
         stdscr.addstr(y-1,0,"Spacebar: pause/resume, ctrl + c: quit", curses.A_BOLD)
+        if x > 82:
+            stdscr.addstr(y-1,x-42,"AMI ping:",curses.A_BOLD)
+            stdscr.addstr(y-1,x-32, ping_text(),curses.A_BOLD)
         stdscr.addstr(y-1,x-20,"Lines:",curses.A_BOLD)
         stdscr.addstr(y-1,x-13, str(len(lines)),curses.A_BOLD)
 
@@ -1313,23 +3286,407 @@ class work_thread(threading.Thread):
                     while self.paused:
                         self.paused_flag.wait()
 
-                # The main program loop.
-                    for l in lines:
-                        l.tick()
-                    sleep(0.1)
+                # The main program loop. Apply whatever Asterisk told
+                # us, then tick only lines with something due.
+                    inbox.drain()
+                    due = scheduler.pop_due()
+                    with state_lock:
+                        for l in due:
+                            l.tick()
+
+                        if due != []:
+                            # Check to make sure we're still sane :)
+                            safetynet()
+
+                    if due != []:
+                        # Never come back for the same line sooner than
+                        # one tick, in case it had nothing to do.
+                        not_before = scheduler.now() + 0.1
+                        for l in due:
+                            scheduler.reschedule(l, not_before)
+
+                scheduler.wait(1)
         except Exception as e:
             logging.exception(e)
 
     def pause(self):
         self.paused = True
         self.paused_flag.acquire()
+        self.paused_at = scheduler.now()
 
     def resume(self):
         self.paused = False
+        scheduler.shift(scheduler.now() - self.paused_at)
         self.paused_flag.notify()
         self.paused_flag.release()
 
 
+class Backpressure():
+    """
+    Holds back call origination when Asterisk is falling behind, and
+    lets it go again once Asterisk catches up.
+
+    Every interval seconds, looks at how many of our .call files are
+    still in the spool, how many calls Asterisk says it has up (from
+    CoreStatus), and how many DialBegins each switch has given up on
+    since last time. Too much of any of those, and that switch's dial
+    limit gets cut in half. (Spool and CoreStatus count against every
+    switch.) Each quiet interval after that gives one sender back, until
+    it's at max_dialing again.
+
+    The spool and CoreStatus are both asked on the way out, and read
+    on the next look, so nothing here waits on the disk or Asterisk
+    while the timer holds state_lock.
+
+    interval:       Seconds between looks.
+    spool_max:      Spool depth over this counts as behind. 0 to ignore.
+    calls_max:      CoreCurrentCalls over this counts as behind. 0 to ignore.
+    timeouts_max:   DialBegin timeouts per interval, per switch, over
+                    this count as behind. 0 to ignore.
+    """
+
+    def __init__(self, interval=2, spool_max=20, calls_max=0, timeouts_max=2):
+        self.interval = interval
+        self.spool_max = spool_max
+        self.calls_max = calls_max
+        self.timeouts_max = timeouts_max
+        self.spool_depth = 0
+        self.current_calls = None
+        self.last_timeouts = {}
+        self.cuts = 0
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            enqueue_event(self.interval, self.sample)
+
+    def got_status(self, response):
+        # CoreStatus answer. Shows up on the AMI thread, whenever.
+        try:
+            self.current_calls = int(response.keys.get('CoreCurrentCalls'))
+        except (TypeError, ValueError):
+            self.current_calls = None
+
+    def ask_status(self):
+        # On the I/O pool. The answer comes back to got_status().
+        try:
+            ami_action('CoreStatus', _callback=self.got_status)
+        except Exception:
+            pass
+
+    def check_spool(self):
+        # On the I/O pool. Stats every file we have in the spool.
+        self.spool_depth = spool.depth()
+
+    def sample(self):
+        # Ask for next time. Neither is worth waiting on here, since
+        # a slow disk or AMI socket is what we're watching for.
+        t_io.submit(self.ask_status)
+        t_io.submit(self.check_spool, blocking=True)
+
+        behind = ((self.spool_max and self.spool_depth > self.spool_max) or
+                  (self.calls_max and self.current_calls is not None
+                   and self.current_calls > self.calls_max))
+
+        for s in originating_switches:
+            timeouts = s.timeouts - self.last_timeouts.get(s.kind, s.timeouts)
+            self.last_timeouts[s.kind] = s.timeouts
+            if behind or (self.timeouts_max and timeouts > self.timeouts_max):
+                self.cut(s, timeouts)
+            elif s.throttle is not None:
+                self.ease(s)
+
+        enqueue_event(self.interval, self.sample)
+
+    def cut(self, s, timeouts):
+        limit = max(1, s.dial_limit // 2)
+        if limit != s.throttle:
+            self.cuts += 1
+            logging.warning("Asterisk is behind (spool: %s, calls: %s, timeouts: %s). "
+                            "Throttling %s to %s dialing.", self.spool_depth,
+                            self.current_calls, timeouts, s.kind, limit)
+        s.throttle = limit
+
+    def ease(self, s):
+        if s.throttle + 1 >= s.max_dialing:
+            s.throttle = None
+            logging.info("Asterisk caught up. %s back to %s dialing.",
+                         s.kind, s.max_dialing)
+        else:
+            s.throttle += 1
+        s.admit()
+
+    def stats(self):
+        """ Returns a dict of counters for the API. """
+        return dict([
+            ('spool_depth', self.spool_depth),
+            ('current_calls', self.current_calls),
+            ('cuts', self.cuts),
+            ('throttled', dict((s.kind, s.dial_limit) for s in originating_switches
+                               if s.throttle is not None)),
+            ])
+
+
+pressure = Backpressure()
+
+
+def make_backpressure():
+    """ Sets up the backpressure controller from [backpressure] in the config. """
+    global pressure
+    pressure = Backpressure(
+        interval=config.getfloat('backpressure', 'interval', fallback=2),
+        spool_max=config.getint('backpressure', 'spool_max', fallback=20),
+        calls_max=config.getint('backpressure', 'calls_max', fallback=0),
+        timeouts_max=config.getint('backpressure', 'timeouts_max', fallback=2))
+
+
+class StressTest():
+    """
+    Finds how many lines a switch can usefully run. Starts it with a
+    few lines, and every interval seconds adds step more, until calls
+    per minute stop going up.
+
+    Each step records completed calls (DialEnds) per minute, average
+    DialBegin latency,
+    how many times a line had to wait for a sender (blocked_senders) or
+    found no channel (blocked_channels), and DialBegin timeouts. The knee
+    is the fewest lines that got within tolerance of the best rate seen.
+    Once patience steps in a row don't beat the best by tolerance, or
+    there are max_lines, the switch goes back the way it was.
+
+    Runs on the timer, so it works the same on any engine, including
+    the simulation.
+
+    switch:     Switch under test.
+    start:      Lines to begin with.
+    step:       Lines added each time.
+    interval:   Seconds per step.
+    max_lines:  Most lines to try. 0 for no limit.
+    tolerance:  Fraction a step has to beat the best rate by, to count
+                as still climbing.
+    patience:   Steps in a row allowed to not climb.
+    steps:      List of dicts, one per finished step.
+    knee:       Number of lines at the knee, once we're done.
+    """
+
+    def __init__(self, switch, start=1, step=1, interval=120, max_lines=0,
+                 tolerance=0.05, patience=3):
+        self.switch = switch
+        self.start_lines = start
+        self.step = step
+        self.interval = interval
+        self.max_lines = max_lines
+        self.tolerance = tolerance
+        self.patience = patience
+        self.steps = []
+        self.knee = None
+        self.done = False
+        self.flat = 0
+        self.best = 0.0
+
+    def start(self):
+        mine = lines.on_switch(self.switch.kind)
+        self.was_running = mine != []
+        self.had_lines = len(mine)
+        logging.info('Stress test on %s: starting at %s lines, adding %s every %ss',
+                     self.switch.kind, self.start_lines, self.step, self.interval)
+        self.set_lines(self.start_lines)
+        self.lines = self.start_lines
+        self.begin()
+
+    def set_lines(self, n):
+        mine = lines.on_switch(self.switch.kind)
+        # Idle lines go first, so we cut off as few calls as we can.
+        # A switch that was running when we started can be busy.
+        extra = sorted(mine, key=lambda l: l.status == 0 and not l.pending_call)[n:]
+        if extra != []:
+            # Hang up on the I/O pool, so the timer never waits on the
+            # AMI socket.
+            t_io.submit(partial(hangup_channels, busy_channels(extra)), blocking=True)
+            for l in extra:
+                lines.remove(l)
+            # Whatever the lines we took were up to, the counters
+            # should only know about the ones left.
+            self.switch.recount()
+        for i in range(n - len(mine)):
+            lines.add(lines.new(self.switch))
+
+    def begin(self):
+        # Counters at the start of a step, to take the difference later.
+        s = self.switch
+        self.began = scheduler.now()
+        self.mark = (s.completed, s.dialed, s.dial_latency, s.blocked_senders,
+                     s.blocked_channels, s.timeouts)
+        enqueue_event(self.interval, self.sample)
+
+    def sample(self):
+        if self.done:
+            return
+        if lines.on_switch(self.switch.kind) == []:
+            # Somebody stopped the switch out from under us.
+            logging.warning('Stress test on %s stopped with the switch.', self.switch.kind)
+            self.done = True
+            return
+
+        s = self.switch
+        completed, dialed, latency, senders, chans, timeouts = [
+            now - then for now, then in zip(
+                (s.completed, s.dialed, s.dial_latency, s.blocked_senders,
+                 s.blocked_channels, s.timeouts),
+                self.mark)]
+        rate = completed * 60 / (scheduler.now() - self.began)
+        self.steps.append(dict([
+            ('lines', self.lines),
+            ('calls_min', rate),
+            ('latency_avg', latency / dialed if dialed else 0.0),
+            ('blocked_senders', senders),
+            ('blocked_channels', chans),
+            ('timeouts', timeouts),
+            ]))
+        logging.info('Stress test on %s: %s lines, %.1f calls/min', s.kind, self.lines, rate)
+
+        if rate > self.best * (1 + self.tolerance):
+            self.flat = 0
+        else:
+            self.flat += 1
+        self.best = max(self.best, rate)
+
+        if self.flat >= self.patience or (self.max_lines and self.lines >= self.max_lines):
+            self.finish()
+        else:
+            n = self.lines + self.step
+            if self.max_lines:
+                n = min(n, self.max_lines)
+            self.set_lines(n)
+            self.lines = n
+            self.begin()
+
+    def finish(self):
+        self.done = True
+        good = [st['lines'] for st in self.steps
+                if st['calls_min'] >= self.best * (1 - self.tolerance)]
+        self.knee = min(good) if good else None
+        logging.info('Stress test on %s done. Knee at %s lines, %.1f calls/min best.',
+                     self.switch.kind, self.knee, self.best)
+
+        # Put things back.
+        if self.was_running:
+            self.set_lines(self.had_lines)
+        else:
+            # What api_stop does to one switch, minus waiting on Asterisk.
+            self.set_lines(0)
+            self.switch.running = False
+            self.switch.is_dialing = 0
+            self.switch.on_call = 0
+
+    def results(self):
+        """ Returns everything so far as a dict, for the API. """
+        return dict([
+            ('switch', self.switch.kind),
+            ('running', not self.done),
+            ('lines', self.lines),
+            ('interval', self.interval),
+            ('step', self.step),
+            ('steps', self.steps),
+            ('knee', self.knee),
+            ('best_calls_min', self.best),
+            ])
+
+
+# The most recent stress test, if there's been one.
+stress = None
+
+
+def make_stress(switch, **kwargs):
+    """
+    Sets up a StressTest on switch from [stress] in the config.
+    Anything in kwargs that's not None wins over the config.
+    """
+    settings = dict([
+        ('start', config.getint('stress', 'start', fallback=1)),
+        ('step', config.getint('stress', 'step', fallback=1)),
+        ('interval', config.getfloat('stress', 'interval', fallback=120)),
+        ('max_lines', config.getint('stress', 'max_lines', fallback=0)),
+        ('tolerance', config.getfloat('stress', 'tolerance', fallback=0.05)),
+        ('patience', config.getint('stress', 'patience', fallback=3)),
+        ])
+    for k, v in kwargs.items():
+        if v is not None:
+            settings[k] = v
+    return StressTest(switch, **settings)
+
+
+def print_stress(test):
+    """ Prints a StressTest's steps as a table. """
+    print('\nStress test on {}, {}s per step.\n'.format(test.switch.kind, test.interval))
+    print(tabulate(
+        [(st['lines'], round(st['calls_min'], 1), round(st['latency_avg'], 2),
+          st['blocked_senders'], st['blocked_channels'], st['timeouts'],
+          '<- knee' if st['lines'] == test.knee else '') for st in test.steps],
+        headers=['lines', 'calls/min', 'DialBegin secs', 'blk senders', 'blk chans',
+                 'timeouts', ''],
+        tablefmt='pipe'))
+    if test.knee is not None:
+        print('\nBest line count for {} is about {}.'.format(test.switch.kind, test.knee))
+    print()
+
+
+def make_io_pool():
+    """ Sets up the I/O pool from the [dispatch] section of the config. """
+    return io_pool(scheduler.now, t_timer,
+                   workers=config.getint('dispatch', 'workers', fallback=2),
+                   size=config.getint('dispatch', 'queue', fallback=64))
+
+
+def start_engine():
+    """
+    Starts whichever engine make_scheduler() picked, and connects to
+    AMI. The scheduler, dispatcher and switches have to be made first,
+    so whatever AMI brings in on login (a resync, early events) lands
+    on the engine we're actually going to run. The timer and I/O pool
+    come up before the connection, and lines start ticking after it.
+    Returns the timer, I/O and work threads (or their stand-ins).
+    """
+    # Set as globals now, not when we return. A resync on login can
+    # already need the timer.
+    global t_timer, t_io
+
+    if scheduler.name == 'asyncio':
+        from aio_engine import aio_timer, aio_pool, aio_thread, aio_ami
+        t_timer = aio_timer(scheduler.loop, state_lock)
+        t_io = aio_pool(scheduler.loop, t_timer,
+                        size=config.getint('dispatch', 'queue', fallback=64))
+        connect()
+        t_work = aio_thread(scheduler)
+        t_work.daemon = True
+        t_work.start()
+        if isinstance(t_ami, aio_ami):
+            t_ami.start()
+        return t_timer, t_io, t_work
+
+    t_timer = timer_thread(scheduler.now, state_lock)
+    t_timer.start()
+    t_io = make_io_pool()
+    t_io.start()
+    connect()
+    t_work = work_thread()
+    t_work.daemon = True
+    t_work.start()
+    return t_timer, t_io, t_work
+
+
+def connect():
+    """ ami_connect() with the [ami] settings, and nothing fatal about it. """
+    try:
+        ami_connect(config.get('ami', 'address'), config.get('ami', 'port'),
+                    config.get('ami', 'user'), config.get('ami', 'secret'))
+    except:
+      #  logging.error('AMI connection failed. This will break things.')
+      #  sys.exit('Failed to connect to Asterisk AMI. Is Asterisk running?')
+      logging.error("all that junk", exc_info=True)
+
+
 class ServiceExit(Exception):
     pass
 
@@ -1348,9 +3705,16 @@ def module_shutdown():
         pass
     t_work.shutdown_flag.set()
     t_work.join()
-
+    t_io.shutdown_flag.set()
+    t_io.join()
+    t_timer.shutdown_flag.set()
+    t_timer.join()
+
+    spool.cleanup()
+    if recorder is not None:
+        recorder.close()
     logging.shutdown()
-    client.logoff()
+    t_ami.logoff()
 
     print("\n\nShutdown requested. Hanging up Asterisk channels, and cleaning up /var/spool/")
 
@@ -1393,16 +3757,39 @@ if __name__ == "__main__":
             filename='/var/log/panel_gen/calls.log',level=logging.DEBUG,
             datefmt='%m/%d/%Y %hh:%M:%S %p')
 
-    # Connect to AMI
-    try:
-        ami_connect(AMI_ADDRESS, AMI_PORT, AMI_USER, AMI_SECRET)
-    except:
-      #  logging.error('AMI connection failed. This will break things.')
-      #  sys.exit('Failed to connect to Asterisk AMI. Is Asterisk running?')
-      logging.error("all that junk", exc_info=True)
-
     # Parse any arguments the user gave us.
     parse_args()
+
+    if args.sim is not None and args.stress is not None:
+        import simulation
+        simulation.run_stress_sim()
+        sys.exit()
+
+    if args.sim is not None:
+        # No Asterisk, no UI, no threads. Just numbers.
+        import simulation
+        simulation.run_simulation()
+        sys.exit()
+
+    if args.stress is not None:
+        # Only the switch under test, and it starts with no lines.
+        args.o = [args.stress]
+
+    if args.bench is not None:
+        import bench
+        bench.run_benchmarks()
+        sys.exit()
+
+    if args.replay is not None:
+        import replay
+        replay.run_replay()
+        sys.exit()
+
+    # AMI gets connected in start_engine(), once all this is set up.
+    make_scheduler()
+    make_dispatcher()
+    make_backpressure()
+    make_recorder()
     make_switch(args)
 
     logging.info('Originating calls on %s', originating_switches)
@@ -1413,19 +3800,26 @@ if __name__ == "__main__":
     logging.info('Call volume set to %s', args.v)
 
     # Here is where we actually make the lines.
-    lines = make_lines(source='main', originating_switches=originating_switches,
-                       numlines = args.a)
+    if args.stress is None:
+        lines.extend(make_lines(source='main', originating_switches=originating_switches,
+                           numlines = args.a))
 
     try:
+        t_timer, t_io, t_work = start_engine()
         t_ui = ui_thread()
         t_ui.daemon = True
         t_ui.start()
-        t_work = work_thread()
-        t_work.daemon = True
-        t_work.start()
+        pressure.start()
+
+        if args.stress is not None:
+            stress = make_stress(originating_switches[0])
+            with state_lock:
+                stress.start()
 
         while True:
             sleep(1)
+            if stress is not None and stress.done:
+                raise ServiceExit
 
     except (KeyboardInterrupt, ServiceExit):
         # Exception handler for console-based shutdown.
@@ -1433,6 +3827,8 @@ if __name__ == "__main__":
         logging.info("--- Caught keyboard interrupt! Shutting down gracefully. ---")
         api_stop(switch='all')
         module_shutdown()
+        if stress is not None:
+            print_stress(stress)
 
     except Exception as e:
         # Exception for any other errors that I'm not explicitly handling.
@@ -1470,29 +3866,23 @@ if __name__ == "panel_gen":
             filename='/var/log/panel_gen/calls.log',level=logging.INFO,
             datefmt='%m/%d/%Y %hh:%M:%S %p')
 
-    # Connect to AMI
-    try:
-        ami_connect(AMI_ADDRESS, AMI_PORT, AMI_USER, AMI_SECRET)
-    except:
-        #logging.error('AMI connection failed. This will break things.')
-        #sys.exit('Failed to connect to Asterisk AMI. Is Asterisk running?')
-        logging.error("all that junk", exc_info=True)
-
     # We call parse_args here just to set some defaults. Otherwise
     # not used when running as module.
     parse_args()
 
-    # Make some switches.
+    # Make some switches. AMI gets connected in start_engine().
+    make_scheduler()
+    make_dispatcher()
+    make_backpressure()
+    make_recorder()
     make_switch(args)
 
 
-    lines = []
     logging.info('Starting panel_gen as thread from http_server')
 
     try:
-        t_work = work_thread()
-        t_work.daemon = True
-        t_work.start()
+        t_timer, t_io, t_work = start_engine()
+        pressure.start()
 
         sleep(.5)
 
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  Plays a recording from EventRecorder back through panel_gen's AMI  #
+#  handlers, on the simulation stand-ins, so whatever the switches    #
+#  did on a bad day can be done again on a laptop.                    #
+#                                                                     #
+#    python panel_gen.py -replay ami.gz                               #
+#    python panel_gen.py -replay ami.gz -speed 10                     #
+#                                                                     #
+#  Lines are made up as they're needed. Each DialBegin for a token we #
+#  haven't seen gets a free line on the switch it was recorded on,    #
+#  set up the way call() would have left it. Lines don't tick, so the #
+#  only calls are the recorded ones.                                  #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+from time import sleep, perf_counter
+from collections import deque
+import logging
+import numpy
+from tabulate import tabulate
+
+from simulation import sim_engine
+import panel_gen as app
+
+
+class Replayer():
+    """
+    Feeds a recording into the handlers, batch by batch.
+
+    speed:      How many times faster than it was recorded. None to go
+                as fast as possible.
+    switches:   Dict of kind -> every switch make_switch() made.
+    idle:       Dict of kind -> deque of lines with nothing going on.
+    timings:    List of (event name, seconds) for every handler run.
+    """
+
+    def __init__(self, speed=None):
+        self.sim = sim_engine()
+        self.speed = speed
+        self.switches = dict((s.kind, s) for s in
+                             (app.Rainier, app.Adams, app.Lakeview, app.Step, app.ESS3))
+        self.idle = dict((kind, deque()) for kind in self.switches)
+        self.timings = []
+        self.adopted = 0
+        self.events = 0
+
+    def adopt(self, event, kind):
+        # Give this call to a line, like call() would have.
+        s = self.switches.get(kind)
+        if s is None:
+            return
+        if s not in app.originating_switches:
+            app.originating_switches.append(s)
+        if self.idle[kind]:
+            l = self.idle[kind].popleft()
+        else:
+            l = app.lines.new(s)
+            app.lines.add(l)
+        l.magictoken = event.token
+        l.pending_call = True
+        l.reserved_chan = s.channels.take(event.chan, l) or None
+        self.adopted += 1
+
+    def play(self, batches):
+        clock = app.scheduler.clock
+        lines = app.lines
+        started = perf_counter()
+        for batch in batches:
+            at = batch[0][0]
+            if self.speed is not None:
+                wait = started + at / self.speed - perf_counter()
+                if wait > 0:
+                    sleep(wait)
+            clock.advance(at)
+            app.t_timer.run_due()
+
+            for t, event, kind in batch:
+                if event.name == 'DialBegin' and lines.by_magictoken(event.token) is None:
+                    self.adopt(event, kind)
+            app.inbox.apply([event for t, event, kind in batch], self.timings)
+            self.events += len(batch)
+
+            for t, event, kind in batch:
+                if event.name == 'Hangup':
+                    l = lines.by_magictoken(event.token)
+                    if l is not None and l.ast_status == 'on_hook' and l not in self.idle[l.kind]:
+                        self.idle[l.kind].append(l)
+
+        # Let the last switching delays run out.
+        clock.advance(clock.t + 60)
+        app.t_timer.run_due()
+        return perf_counter() - started
+
+
+def run_replay():
+    """
+    What -replay does. Plays the recording, then prints handler
+    throughput and latency, and where the lines and switches ended up.
+    """
+    args = app.args
+    logging.getLogger().setLevel(logging.WARNING)
+
+    speed = None if args.speed == 'max' else float(args.speed)
+    batches = app.read_recording(args.replay)
+    r = Replayer(speed)
+    took = r.play(batches)
+
+    spent = sum(t for name, t in r.timings)
+    recorded = batches[-1][-1][0] if batches else 0
+    print('\nReplayed {} events in {} batches ({:.0f}s recorded) in {:.2f}s at {} speed.'.format(
+        r.events, len(batches), recorded, took,
+        'full' if speed is None else '{:g}x'.format(speed)))
+    print('{} calls, {} repeats skipped. Handlers ran {:.0f} events/s.\n'.format(
+        r.adopted, app.inbox.coalesced, len(r.timings) / spent if spent else 0))
+
+    rows = []
+    for name in app.ami_dispatch:
+        t = numpy.array([t for n, t in r.timings if n == name]) * 1e6
+        if len(t) == 0:
+            continue
+        rows.append([name, len(t)] + list(numpy.percentile(t, [50, 90, 99])) + [t.max()])
+    print(tabulate(rows, headers=['handler', 'events', 'p50 us', 'p90 us', 'p99 us', 'max us'],
+                   tablefmt='pipe', floatfmt='.1f'))
+    print()
+
+    statuses = app.LineTable.AST_STATUS
+    rows = []
+    for s in app.originating_switches:
+        mine = app.lines.on_switch(s.kind)
+        c = s.counters()
+        rows.append([s.kind, len(mine)] +
+                    [sum(1 for l in mine if l.ast_status == a) for a in statuses] +
+                    [c['is_dialing'], c['on_call'], c['pending'], c['channels_inuse']])
+    print(tabulate(rows, headers=['switch', 'lines'] + statuses +
+                   ['is_dialing', 'on_call', 'pending', 'channels_inuse'], tablefmt='pipe'))
+    print()
@@ -0,0 +1,411 @@
+#!/usr/bin/python3
+#---------------------------------------------------------------------#
+#                                                                     #
+#  Runs panel_gen against a pretend Asterisk on a pretend clock, as   #
+#  fast as the CPU will go. Nothing ever sleeps: when there's nothing #
+#  left to do right now, the clock jumps straight to whatever is due  #
+#  next. Lines, switches, gammas and max_dialing all come from        #
+#  panel_gen.conf like normal, so a day in here looks like a day at   #
+#  the museum. Good for working out lines_normal and lines_heavy      #
+#  before touching the hardware.                                      #
+#                                                                     #
+#    python panel_gen.py -sim 24 -o 5xb                               #
+#    python panel_gen.py -sim 24 -o all -v heavy -simlines 4,8,12,16  #
+#    python panel_gen.py -sim 24 -stress 5xb                          #
+#                                                                     #
+#  The pieces below stand in for the threaded ones, same as the       #
+#  asyncio engine's do, so nothing else knows it's not real. The      #
+#  benchmarks (bench.py) and replay (replay.py) run on them too.      #
+#                                                                     #
+#---------------------------------------------------------------------#
+
+from time import monotonic
+from heapq import heappop
+from functools import partial
+import logging
+from numpy import random
+from tabulate import tabulate
+from asterisk.ami import Response
+
+from engine import HeapTimer, Pool
+import panel_gen as app
+
+# Seconds from DialBegin to DialEnd, by switch, unless the [simulation]
+# section says otherwise. This is how long a call holds a sender.
+SIM_DIAL_TIMES = {
+    'panel':    12,
+    '5xb':      8,
+    '1xb':      8,
+    'step':     10,
+    '3ess':     4,
+    }
+
+
+class VirtualClock():
+    """ A clock that only moves when it's told to. """
+
+    def __init__(self, start=0.0):
+        self.t = start
+
+    def __call__(self):
+        return self.t
+
+    def advance(self, t):
+        if t > self.t:
+            self.t = t
+
+
+class SimScheduler(app.Scheduler):
+    """
+    Scheduler on a VirtualClock. Nobody waits on it. simulate() asks
+    when the next line is due, and moves the clock there.
+    """
+
+    def next_due(self):
+        with self.wakeup:
+            while self.heap and self.heap[0][2] is None:
+                heappop(self.heap)
+            if self.heap:
+                return self.heap[0][0]
+        return float('inf')
+
+    def wait(self, timeout):
+        pass
+
+
+class SimLineTable(app.LineTable):
+    """ LineTable on a VirtualClock. Same deal as SimScheduler. """
+
+    def next_due(self):
+        return self.earliest
+
+    def wait(self, timeout):
+        pass
+
+
+# What the simulation and benchmarks can run on, by [engine] name.
+# asyncio needs a real event loop, so it gets the heap, which is what
+# its LoopScheduler most looks like anyway.
+SIM_SCHEDULERS = {
+    'heap':     SimScheduler,
+    'array':    SimLineTable,
+    }
+
+
+def sim_scheduler_kind():
+    """ -engine if given, else scheduler under [engine], if we can simulate it. """
+    kind = app.args.engine or app.config.get('engine', 'scheduler', fallback='heap')
+    if kind not in SIM_SCHEDULERS:
+        kind = 'heap'
+    return kind
+
+
+class sim_timer(HeapTimer):
+    # Stands in for timer_thread. Never started. Callbacks sit in the
+    # heap until simulate() moves the clock past them.
+
+    def run_due(self):
+        """ Runs every callback that's due, including ones they add. """
+        while self.next_due() <= self.clock():
+            due, n, handle = heappop(self.heap)
+            self.fire(handle)
+
+
+class sim_pool(Pool):
+    # Stands in for io_pool. The pretend Asterisk never blocks, so jobs
+    # just run on the spot.
+
+    def submit(self, job, owner=None, failed=None, blocking=True):
+        self.run_job(self.clock(), job, owner, failed)
+        return True
+
+
+class SimAsterisk():
+    """
+    The pretend Asterisk. Takes calls from SimDispatcher and actions
+    from SimAMIAdapter, and plays each call out on the timer as
+    DialBegin, DialEnd and Hangup, straight into the handlers.
+    Every delay is nudged up to 20% either way, so calls don't all
+    move in lockstep.
+
+    seize:      Seconds from originate to DialBegin.
+    dial:       Dict of switch kind -> seconds from DialBegin to DialEnd.
+    clear:      Seconds from a Hangup action to the Hangup event.
+    calls:      Dict of DAHDI channel -> accountcode for calls up.
+    offered:    Dict of switch kind -> calls we were asked to place.
+    placed:     Dict of switch kind -> DialBegins sent.
+    completed:  Dict of switch kind -> Hangups sent.
+    """
+
+    def __init__(self, seize=0.5, dial=None, clear=0.2):
+        self.seize = seize
+        self.dial = dial or {}
+        self.clear = clear
+        self.calls = {}
+        self.kinds = {}
+        self.offered = {}
+        self.placed = {}
+        self.completed = {}
+        self.busy = 0
+
+    def jitter(self, seconds):
+        return seconds * random.uniform(0.8, 1.2)
+
+    def event(self, name, token, chan):
+        if name == 'DialBegin':
+            kind = self.kinds[token]
+            self.placed[kind] = self.placed.get(kind, 0) + 1
+        app.ami_dispatch[name](app.CallEvent(name, token, chan))
+
+    def originate(self, channel, variables, callerid, account):
+        chan = channel.split('/')[1]
+        kind = callerid[callerid.find('<') + 1:callerid.rfind('>')]
+        self.offered[kind] = self.offered.get(kind, 0) + 1
+        if chan in self.calls:
+            # Real Asterisk would fail it, and the line would time out.
+            self.busy += 1
+            return
+        self.calls[chan] = account
+        self.kinds[account] = kind
+
+        # Everything about this call belongs to its token, so a hangup
+        # can cancel whatever hasn't happened yet.
+        begin = self.jitter(self.seize)
+        end = begin + self.jitter(self.dial.get(kind, 8))
+        app.enqueue_event(begin, partial(self.event, 'DialBegin', account, chan),
+                          owner=account)
+        app.enqueue_event(end, partial(self.event, 'DialEnd', account, chan), owner=account)
+        # The dialplan hangs up on its own after waittime.
+        app.enqueue_event(float(variables.get('waittime', 60)), partial(self.hungup, chan),
+                          owner=account)
+
+    def hungup(self, chan):
+        token = self.calls.pop(chan, None)
+        if token is None:
+            return
+        app.t_timer.cancel_owner(token)
+        kind = self.kinds.pop(token)
+        self.completed[kind] = self.completed.get(kind, 0) + 1
+        self.event('Hangup', token, chan)
+
+    def action(self, name, _callback=None, variables={}, **keys):
+        """
+        Answers an AMI action right away. Only Hangup does anything.
+        The callback runs before this returns, since there's nobody
+        else to run it, and the clock can't move while someone's
+        waiting on it.
+        """
+        response = Response('Success', {})
+        if name == 'Hangup':
+            chan = keys.get('Channel', '')[len('DAHDI/'):].split('-')[0]
+            token = self.calls.get(chan)
+            if token is None:
+                response = Response('Error', {'Message': 'No such channel'})
+            else:
+                app.enqueue_event(self.jitter(self.clear), partial(self.hungup, chan),
+                                  owner=token)
+        if _callback is not None:
+            _callback(response)
+        return response
+
+
+class SimDispatcher(app.Dispatcher):
+    """ Hands calls to the pretend Asterisk. """
+
+    name = 'simulated'
+    blocking = False
+
+    def __init__(self, sim):
+        app.Dispatcher.__init__(self)
+        self.sim = sim
+
+    def originate(self, channel, exten, variables, callerid, account=None):
+        self.sim.originate(channel, variables, callerid, account)
+        self.sent += 1
+
+
+class SimAMIAdapter():
+    """ Same idea as python-ami's AMIClientAdapter, for SimAsterisk. """
+
+    def __init__(self, sim):
+        self._sim = sim
+
+    def __getattr__(self, item):
+        return partial(self._sim.action, item)
+
+
+def sim_engine():
+    """
+    Swaps the simulation stand-ins into panel_gen, with a fresh set of
+    switches and no lines yet. Returns the SimAsterisk.
+    """
+    config = app.config
+    app.scheduler = SIM_SCHEDULERS[sim_scheduler_kind()](VirtualClock())
+    app.t_timer = sim_timer(app.scheduler.now, app.state_lock)
+    app.t_io = sim_pool(app.scheduler.now, app.t_timer)
+    sim = SimAsterisk(
+        seize=config.getfloat('simulation', 'seize_time', fallback=0.5),
+        clear=config.getfloat('simulation', 'hangup_time', fallback=0.2),
+        dial=dict((kind, config.getfloat('simulation', 'dial_' + kind, fallback=secs))
+                  for kind, secs in SIM_DIAL_TIMES.items()))
+    app.dispatcher = SimDispatcher(sim)
+    app.adapter = SimAMIAdapter(sim)
+    app.lines = app.LineRegistry()
+    app.channels_busy.clear()
+    app.make_switch(app.args)
+    return sim
+
+
+def sim_next(end):
+    """ When the next thing happens, or end if nothing happens before that. """
+    return min(app.scheduler.next_due(), app.t_timer.next_due(), end)
+
+
+def sim_step(due):
+    """ Moves the clock to due, and does everything that's due by then. """
+    scheduler = app.scheduler
+    scheduler.clock.advance(due)
+
+    # Same order as work_thread, with the timer thread's turn first.
+    app.t_timer.run_due()
+    due = scheduler.pop_due()
+    for l in due:
+        l.tick()
+    if due != []:
+        app.safetynet()
+        not_before = scheduler.now() + 0.1
+        for l in due:
+            scheduler.reschedule(l, not_before)
+
+
+def simulate(hours, numlines=None):
+    """
+    Runs hours of traffic on the originating switches, on a virtual
+    clock, against SimAsterisk. Starts from scratch every time.
+
+    numlines:   Lines per switch. Defaults to lines_normal, or
+                lines_heavy with -v heavy, or -a if given.
+
+    Returns a list of dicts, one per switch.
+    """
+    args = app.args
+    sim = sim_engine()
+    clock = app.scheduler.clock
+    lines = app.lines
+    switches = app.originating_switches
+
+    for s in switches:
+        if args.v == 'heavy':
+            s.traffic_load = 'heavy'
+        if numlines is not None:
+            n = numlines
+        elif args.a != []:
+            n = args.a
+        elif s.traffic_load == 'heavy':
+            n = s.lines_heavy
+        else:
+            n = s.lines_normal
+        lines.extend([lines.new(s) for i in range(n)])
+
+    # Time-weighted sums of senders and channels in use, for averages.
+    senders = dict((s.kind, 0.0) for s in switches)
+    chans = dict((s.kind, 0.0) for s in switches)
+    peak = dict((s.kind, 0) for s in switches)
+
+    end = hours * 3600
+    while clock.t < end:
+        due = sim_next(end)
+        dt = due - clock.t
+        for s in switches:
+            senders[s.kind] += s.is_dialing * dt
+            chans[s.kind] += s.channels.in_use() * dt
+        sim_step(due)
+        for s in switches:
+            peak[s.kind] = max(peak[s.kind], s.is_dialing)
+
+    results = []
+    for s in switches:
+        placed = sim.placed.get(s.kind, 0)
+        blocked = s.blocked_senders + s.blocked_channels
+        tries = sim.offered.get(s.kind, 0) + blocked
+        results.append(dict([
+            ('switch', s.kind),
+            ('lines', len(lines.on_switch(s.kind))),
+            ('calls', placed),
+            ('calls_hr', placed / hours),
+            ('completed', sim.completed.get(s.kind, 0)),
+            ('senders_avg', senders[s.kind] / end),
+            ('senders_peak', peak[s.kind]),
+            ('max_dialing', s.max_dialing),
+            ('occupancy', senders[s.kind] / end / s.max_dialing),
+            ('channels_avg', chans[s.kind] / end),
+            ('channels', s.channels.total),
+            ('blocked_senders', s.blocked_senders),
+            ('blocked_channels', s.blocked_channels),
+            ('blocking', blocked / tries if tries else 0.0),
+            ('wait_avg', s.wait_total / s.admitted if s.admitted else 0.0),
+            ('timeouts', s.timeouts),
+            ]))
+    return results
+
+
+def run_simulation():
+    """
+    What -sim does. Runs the simulation once, or once per line count
+    in -simlines, and prints a table.
+    """
+    args = app.args
+
+    # A day's worth of INFO would bury the log.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.simlines is None:
+        counts = [None]
+    else:
+        counts = [int(n) for n in args.simlines.split(',')]
+
+    rows = []
+    for n in counts:
+        started = monotonic()
+        results = simulate(args.sim, n)
+        took = monotonic() - started
+        for r in results:
+            r['took'] = took
+            rows.append(r)
+
+    print('\nSimulated {} hours of {} traffic on the {} scheduler.\n'.format(
+        args.sim, args.v, sim_scheduler_kind()))
+    print(tabulate(
+        [(r['switch'], r['lines'], r['calls'], round(r['calls_hr'], 1),
+          '{:.0%}'.format(r['occupancy']), r['senders_peak'], r['max_dialing'],
+          '{:.1f}/{}'.format(r['channels_avg'], r['channels']),
+          r['blocked_senders'], r['blocked_channels'], '{:.1%}'.format(r['blocking']),
+          round(r['wait_avg'], 1), round(r['took'], 1)) for r in rows],
+        headers=['switch', 'lines', 'calls', 'calls/hr', 'sender occ.', 'peak',
+                 'max_dialing', 'channels', 'blk senders', 'blk chans', 'blocking',
+                 'wait avg', 'secs'],
+        tablefmt='pipe'))
+    print()
+    return rows
+
+
+def run_stress_sim():
+    """
+    What -stress does with -sim. Runs the stress test on the simulation,
+    for no more than -sim hours, and prints the steps.
+    """
+    args = app.args
+    logging.getLogger().setLevel(logging.WARNING)
+
+    args.o = [args.stress]
+    sim_engine()
+    stress = app.stress = app.make_stress(app.originating_switches[0])
+    stress.start()
+
+    end = args.sim * 3600
+    while not stress.done and app.scheduler.now() < end:
+        sim_step(sim_next(end))
+    if not stress.done:
+        logging.warning('Ran out of time before the stress test finished.')
+        stress.finish()
+    app.print_stress(stress)